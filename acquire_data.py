@@ -1,19 +1,39 @@
-from baseball_types import Game
-from typing import Dict, List, Tuple, Any
-from event_log_parser import parse_events_directory
+from __future__ import annotations
+from baseball_types import Game, GameTable
+from typing import Dict, List, Tuple, Callable, TYPE_CHECKING
+from event_log_parser import parse_event_files, find_win_loss, PlayerIdResolver
+from instrumentation import stage
+from stat_cache import cached_stats
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 import itertools
+import hashlib
+import json
 
-import pybaseball
-import pandas as pd
 import numpy as np
-import yaml
 import os
-from tqdm import tqdm
 
+# pandas and tqdm are slow to import, so they are only imported where they're used
+if TYPE_CHECKING:
+    import pandas as pd
 
-GAME_YAML_PATH = ".\\games.yaml"
+
+GAMES_DIR = ".\\games"  # One subdirectory of .npy columns per season
 DATASET_PATH = ".\\dataset.npz"
+SHARD_DIR = ".\\dataset"  # Memory-mappable .npy shards of dataset.npz, already split and shuffled
+SHARD_ROWS = 65536
+FEATURE_STORE_DIR = ".\\features"  # Per-season .npy feature columns with a manifest of source hashes
+SPLIT_FRACTIONS = {"train": 0.64, "valid": 0.16, "test": 0.2}  # Same proportions as the two 80/20 splits
 RETRO_EVENTS_DIR = "C:\\Users\\lplab\\Documents\\Retrosheet\\events"
+PLAYER_REGISTER_PATH = None  # Optional local copy of the Chadwick register's people.csv
+PARSE_WORKERS = os.cpu_count()
+
+N_BATTERS = 18  # Columns of the player ID matrix: both lineups, both defenses, both starters
+N_FIELDERS = 16
+N_PITCHERS = 2
+# Every stat that's fetched gets indexed, so a feature spec can use any of them
+BATTING_INDEX_STATS = ["BsR", "wRC+", "Def", "WAR", "OPS"]
+PITCHING_INDEX_STATS = ["FIP", "BABIP", "WAR", "W"]
 
 
 def replacement_fip(year: int) -> float:
@@ -23,63 +43,197 @@ def replacement_fip(year: int) -> float:
                        2015: 3.96, 2016: 4.19, 2017: 4.36, 2018: 4.15,
                        2019: 4.51, 2020: 4.45, 2021: 4.27, 2022: 3.97,
                        2023: 4.33}
+    # Seasons outside the table (e.g. the current one at prediction time) use the closest known season
+    year = min(max(year, min(average_fip_lut)), max(average_fip_lut))
     return average_fip_lut[year] + 0.2
 
 
-def games_yaml(start_season, end_season) -> Dict[str, Any]:
-    if os.path.exists(GAME_YAML_PATH):
-        with open(GAME_YAML_PATH, "r") as file:
-            data = yaml.safe_load(file)
-            if data.get("start_season") == start_season and data.get("end_season") == end_season:
-                # yaml has the right seasons, no need to do anything
-                print("Successfully found cached game data")
-                return data
-        # have a file but it has the wrong contents -> delete
-        print("Found cached data with incorrect contents. Deleting.")
-        os.remove(GAME_YAML_PATH)
-    # By the time we reach this point, there is no cached game yaml
-    print("Parsing event files.")
-    all_games = parse_events_directory(RETRO_EVENTS_DIR, start_season, end_season)
-    contents = {"start_season": start_season,
-                "end_season": end_season,
-                "games": [game.__dict__ for game in all_games]}
-    with open(GAME_YAML_PATH, "w") as file:
-        yaml.safe_dump(contents, file)
-    print("Game data cached successfully")
-    return contents
+BATTER_STATS = [("BsR", -2.0), ("wRC+", 80.0)]
+FIELDER_STATS = [("Def", -4.0)]
+
+
+def pitcher_stats(year: int) -> List[Tuple[str, float]]:
+    return [("FIP", replacement_fip(year)), ("BABIP", 0.305)]
+
+
+def season_dir(season: int) -> str:
+    return os.path.join(GAMES_DIR, str(season))
+
+
+def file_hash(path: Path) -> str:
+    with open(path, "rb") as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+def file_signature(path: Path, known) -> list:
+    # [size, mtime in ns, sha1], the file is only read again if its size or mtime changed since it was last hashed
+    stat = os.stat(path)
+    if isinstance(known, list) and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return known
+    return [stat.st_size, stat.st_mtime_ns, file_hash(path)]
+
+
+def signature_hash(signature) -> str:
+    # Older manifests stored just the sha1
+    return signature[2] if isinstance(signature, list) else signature
+
+
+def update_season(season: int, resolver: PlayerIdResolver, executor: ProcessPoolExecutor) -> bool:
+    # Parses only the event files that are new or changed since the season was cached, returns whether anything changed
+    path = season_dir(season)
+    manifest_path = os.path.join(path, "manifest.json")
+    manifest: Dict[str, list] = {}
+    if GameTable.exists(path) and os.path.exists(manifest_path):
+        with open(manifest_path, "r") as file:
+            manifest = json.load(file)
+
+    files = sorted(Path(RETRO_EVENTS_DIR).glob(f"{season}*"))
+    signatures = {file.name: file_signature(file, manifest.get(file.name)) for file in files}
+    changed = [file for file in files
+               if file.name not in manifest or signature_hash(manifest[file.name]) != signatures[file.name][2]]
+    if len(changed) == 0 and len(manifest) > 0:
+        if signatures != manifest:
+            # Touched but unchanged files, remember their new mtimes so they aren't hashed again next time
+            with open(manifest_path, "w") as file:
+                json.dump(signatures, file, indent=2)
+        return False
+
+    print(f"Parsing {len(changed)} new or changed event files for {season}.")
+    new_games = parse_event_files(changed, resolver, executor, desc=str(season))
+    new_ids = {game.game_id for game in new_games}
+    games = new_games
+    if len(manifest) > 0:
+        # Freshly parsed games replace any earlier version of the same game
+        games += [game for game in GameTable.load(path) if game.game_id not in new_ids]
+    # Records depend on every earlier game, so they are recounted for the whole season
+    find_win_loss(games)
+    GameTable.from_games(games).save(path)
+    with open(manifest_path, "w") as file:
+        json.dump(signatures, file, indent=2)
+    print(f"Game data for {season} cached successfully")
+    return True
+
+
+def load_games(start_season, end_season) -> GameTable:
+    resolver = PlayerIdResolver(register_path=PLAYER_REGISTER_PATH)
+    with stage("game store") as record, ProcessPoolExecutor(max_workers=PARSE_WORKERS) as executor:
+        updated = [update_season(season, resolver, executor) for season in range(start_season, end_season+1)]
+        if not any(updated):
+            print("Successfully found cached game data")
+        games = GameTable.concatenate([GameTable.load(season_dir(season)) for season in range(start_season, end_season+1)])
+        record.items += len(games)
+        record.cache_hits += updated.count(False)  # Seasons served from the store without parsing
+        record.cache_misses += updated.count(True)
+    return games
+
+
+class StatIndex:
+    # Dense (player, season, stat) table so lookups are a gather instead of a DataFrame scan
+    def __init__(self, data: pd.DataFrame, stats: List[str]):
+        self.stats = {stat: idx for idx, stat in enumerate(stats)}
+        seasons = data["Season"].to_numpy(dtype=np.int64)
+        self.first_season = int(seasons.min()) if len(seasons) > 0 else 0
+        self.n_seasons = int(seasons.max()) - self.first_season + 1 if len(seasons) > 0 else 1
+        self.player_ids, player_idx = np.unique(data["IDfg"].to_numpy(dtype=np.int64), return_inverse=True)
+        if len(self.player_ids) == 0:
+            # Nobody qualifies in the first weeks of a season, a placeholder that's never found sends every lookup
+            # to the defaults
+            self.player_ids = np.array([np.iinfo(np.int64).min])
+        self.found = np.zeros((len(self.player_ids), self.n_seasons), dtype=bool)
+        self.found[player_idx, seasons - self.first_season] = True
+        self.table = np.zeros((len(self.player_ids), self.n_seasons, len(stats)))
+        self.table[player_idx, seasons - self.first_season] = data[stats].to_numpy(dtype=np.float64)
+
+    def lookup(self, player_ids: np.ndarray, seasons: np.ndarray, stats: List[Tuple[str, float]]) -> np.ndarray:
+        # Returns an array of shape player_ids.shape + (len(stats),), using the defaults for missing players
+        player_ids = np.asarray(player_ids, dtype=np.int64)
+        seasons = np.broadcast_to(np.asarray(seasons, dtype=np.int64), player_ids.shape)
+        player_idx = np.minimum(np.searchsorted(self.player_ids, player_ids), len(self.player_ids)-1)
+        season_idx = np.clip(seasons - self.first_season, 0, self.n_seasons-1)
+        found = ((self.player_ids[player_idx] == player_ids)
+                 & (seasons >= self.first_season)
+                 & (seasons < self.first_season + self.n_seasons))
+        found &= self.found[player_idx, season_idx]
+
+        columns = [self.stats[stat] for stat, _ in stats]
+        defaults = np.array([default for _, default in stats])
+        values = self.table[player_idx, season_idx][..., columns]
+        return np.where(found[..., np.newaxis], values, defaults)
+
+    def source_hash(self, season: int, stat: str) -> str:
+        # Only covers the season's own rows, so players added in other seasons don't invalidate it
+        digest = hashlib.sha1()
+        if self.first_season <= season < self.first_season + self.n_seasons:
+            season_idx = season - self.first_season
+            rows = self.found[:, season_idx]
+            digest.update(self.player_ids[rows].tobytes())
+            digest.update(self.table[rows, season_idx, self.stats[stat]].tobytes())
+        return digest.hexdigest()
+
+
+def fetch_stat_indexes(start_season: int, end_season: int) -> Tuple[StatIndex, StatIndex]:
+    with stage("stat fetch") as record:
+        print("Fetching player batting and fielding stats")
+        batting_data = cached_stats("batting_stats", start_season, end_season,
+                                    stat_columns=["G", "BSR", "WRC_PLUS", "DEF", "WAR", "OPS"], qual=50)
+        print("Fetching player pitching stats")
+        pitching_data = cached_stats("pitching_stats", start_season, end_season,
+                                     stat_columns=["G", "W", "FIP", "BABIP", "WAR"], qual=30)
+        record.items += len(batting_data) + len(pitching_data)
+        return StatIndex(batting_data, BATTING_INDEX_STATS), StatIndex(pitching_data, PITCHING_INDEX_STATS)
 
 
 def game_to_features(game: Game,
-                     batting_data: pd.DataFrame,
-                     pitching_data: pd.DataFrame,
+                     batting_index: StatIndex,
+                     pitching_index: StatIndex,
                      batter_stats: List[Tuple[str, float]],
                      fielder_stats: List[Tuple[str, float]],
                      pitcher_stats: List[Tuple[str, float]]) -> np.ndarray:
+    batters = batting_index.lookup(game.home_lineup + game.away_lineup, game.year, batter_stats)
+    fielders = batting_index.lookup(game.home_defense + game.away_defense, game.year, fielder_stats)
+    pitchers = pitching_index.lookup([game.home_starter, game.away_starter], game.year, pitcher_stats)
+    return np.concatenate([batters.ravel(), fielders.ravel(), pitchers.ravel()])
+
+
+def games_to_id_matrix(games: GameTable) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Player IDs are laid out in the same order game_to_features consumes them
+    columns = games.columns
+    player_ids = np.concatenate([columns["home_lineup"], columns["away_lineup"],
+                                 columns["home_defense"], columns["away_defense"],
+                                 columns["home_starter"][:, np.newaxis], columns["away_starter"][:, np.newaxis]],
+                                axis=1).astype(np.int64)
+    seasons = columns["year"].astype(np.int64)
+    results = columns["home_team_won"].astype(int)[:, np.newaxis]
+    return player_ids, seasons, results
+
+
+def build_feature_matrix(player_ids: np.ndarray,
+                         seasons: np.ndarray,
+                         batting_index: StatIndex,
+                         pitching_index: StatIndex,
+                         batter_stats: List[Tuple[str, float]],
+                         fielder_stats: List[Tuple[str, float]],
+                         pitcher_stats: Callable[[int], List[Tuple[str, float]]]) -> np.ndarray:
+    n_games = player_ids.shape[0]
+    batters = player_ids[:, :N_BATTERS]
+    fielders = player_ids[:, N_BATTERS:N_BATTERS+N_FIELDERS]
+    pitchers = player_ids[:, N_BATTERS+N_FIELDERS:]
     features = []
-    for batter in itertools.chain(game.home_lineup, game.away_lineup):
-        batter_data = batting_data[(batting_data["IDfg"]==batter) & (batting_data["Season"]==game.year)]
-        for stat, default in batter_stats:
-            val = default if len(batter_data)==0 else batter_data[stat].item()
-            features.append(val)
-    for fielder in itertools.chain(game.home_defense, game.away_defense):
-        fielder_data = batting_data[(batting_data["IDfg"]==fielder) & (batting_data["Season"]==game.year)]
-        for stat, default in fielder_stats:
-            val = default if len(fielder_data)==0 else fielder_data[stat].item()
-            features.append(val)
-    for pitcher in [game.home_starter, game.away_starter]:
-        pitcher_data = pitching_data[(pitching_data["IDfg"]==pitcher) & (pitching_data["Season"]==game.year)]
-        for stat, default in pitcher_stats:
-            val = default if len(pitcher_data)==0 else pitcher_data[stat].item()
-            features.append(val)
-    return np.array(features)
-
-
-def game_from_dict(dct: Dict[str, Any]) -> Game:
-    game = Game()
-    for k, v in dct.items():
-        if hasattr(game, k):
-            game.__setattr__(k, v)
-    return game
+
+    # Defaults can vary by season, so do one gather per season
+    for season in np.unique(seasons):
+        rows = seasons == season
+        season_pitcher_stats = pitcher_stats(int(season))
+        features.append(np.concatenate([
+            batting_index.lookup(batters[rows], season, batter_stats).reshape(-1, N_BATTERS*len(batter_stats)),
+            batting_index.lookup(fielders[rows], season, fielder_stats).reshape(-1, N_FIELDERS*len(fielder_stats)),
+            pitching_index.lookup(pitchers[rows], season, season_pitcher_stats).reshape(-1, N_PITCHERS*len(season_pitcher_stats))
+        ], axis=1))
+    # Put rows back in game order
+    order = np.concatenate([np.flatnonzero(seasons == season) for season in np.unique(seasons)])
+    out = np.empty((n_games, features[0].shape[1]))
+    out[order] = np.concatenate(features, axis=0)
+    return out
 
 
 def generate_feature_names(batter_stats: List[str], fielder_stats: List[str], pitcher_stats: List[str]) -> List[str]:
@@ -94,42 +248,160 @@ def generate_feature_names(batter_stats: List[str], fielder_stats: List[str], pi
     return feature_names
 
 
-def generate_numpy_dataset(start_season, end_season):
+def feature_sources(batter_stats: List[Tuple[str, float]],
+                    fielder_stats: List[Tuple[str, float]],
+                    pitcher_stats: Callable[[int], List[Tuple[str, float]]]) -> List[Tuple[int, bool, str, Callable]]:
+    # (player ID matrix column, uses the pitching index, stat, default by season) for each feature,
+    # in the same order as generate_feature_names
+    sources = []
+    for column, (stat, default) in itertools.product(range(N_BATTERS), batter_stats):
+        sources.append((column, False, stat, lambda season, default=default: default))
+    for column, (stat, default) in itertools.product(range(N_BATTERS, N_BATTERS+N_FIELDERS), fielder_stats):
+        sources.append((column, False, stat, lambda season, default=default: default))
+    pitcher_columns = range(N_BATTERS+N_FIELDERS, N_BATTERS+N_FIELDERS+N_PITCHERS)
+    for column, (idx, (stat, _)) in itertools.product(pitcher_columns, enumerate(pitcher_stats(0))):
+        sources.append((column, True, stat, lambda season, idx=idx: pitcher_stats(season)[idx][1]))
+    return sources
+
+
+def array_hash(array: np.ndarray) -> str:
+    return hashlib.sha1(np.ascontiguousarray(array).tobytes()).hexdigest()
+
+
+class FeatureStore:
+    # Every feature column is kept per season along with a hash of the games, player IDs and stats it was computed
+    # from, so adding a stat or a season only computes the columns that are new or out of date
+    def __init__(self, path: str = FEATURE_STORE_DIR):
+        self.path = path
+
+    def column_path(self, season: int, name: str) -> str:
+        return os.path.join(self.path, str(season), name.replace("/", "_") + ".npy")
+
+    def build(self,
+              games: GameTable,
+              batting_index: StatIndex,
+              pitching_index: StatIndex,
+              batter_stats: List[Tuple[str, float]],
+              fielder_stats: List[Tuple[str, float]],
+              pitcher_stats: Callable[[int], List[Tuple[str, float]]],
+              rebuild: bool = False) -> np.ndarray:
+        # Same matrix as build_feature_matrix, with stored columns read back instead of recomputed
+        player_ids, seasons, _ = games_to_id_matrix(games)
+        game_ids = games.columns["game_id"]
+        names = generate_feature_names([stat for stat, _ in batter_stats],
+                                       [stat for stat, _ in fielder_stats],
+                                       [stat for stat, _ in pitcher_stats(0)])
+        sources = feature_sources(batter_stats, fielder_stats, pitcher_stats)
+        features = np.empty((len(games), len(names)))
+
+        with stage("feature store") as record:
+            for season in np.unique(seasons).tolist():
+                rows = np.flatnonzero(seasons == season)
+                manifest_path = os.path.join(self.path, str(season), "manifest.json")
+                manifest: Dict[str, str] = {}
+                if not rebuild and os.path.exists(manifest_path):
+                    with open(manifest_path, "r") as file:
+                        manifest = json.load(file)
+                os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+
+                games_hash = array_hash(game_ids[rows])
+                id_hashes = {}
+                for k, (name, (column, pitching, stat, default)) in enumerate(zip(names, sources)):
+                    index = pitching_index if pitching else batting_index
+                    ids = player_ids[rows, column]
+                    if column not in id_hashes:
+                        id_hashes[column] = array_hash(ids)
+                    source = f"{games_hash}{id_hashes[column]}{index.source_hash(season, stat)}{default(season)!r}"
+                    source = hashlib.sha1(source.encode()).hexdigest()
+                    path = self.column_path(season, name)
+                    if manifest.get(name) == source and os.path.exists(path):
+                        features[rows, k] = np.load(path, mmap_mode="r")
+                        record.cache_hits += 1
+                    else:
+                        values = index.lookup(ids, season, [(stat, default(season))])[:, 0]
+                        np.save(path, values)
+                        manifest[name] = source
+                        features[rows, k] = values
+                        record.cache_misses += 1
+                    record.items += 1
+
+                with open(manifest_path, "w") as file:
+                    json.dump(manifest, file, indent=2)
+        return features
+
+
+def generate_numpy_dataset(start_season, end_season, batch: bool = True, rebuild: bool = False):
     print("Fetching game log data")
-    games_data = games_yaml(start_season, end_season)
-    print("Fetching player batting and fielding stats")
-    batting_data = pybaseball.batting_stats(start_season=start_season, end_season=end_season,
-                                            stat_columns=["G", "BSR", "WRC_PLUS", "DEF", "WAR", "OPS"],
-                                            split_seasons=True, qual=50)
-    print("Fetching player pitching stats")
-    pitching_data = pybaseball.pitching_stats(start_season=start_season, end_season=end_season,
-                                              stat_columns=["G", "W", "FIP", "BABIP", "WAR"],
-                                              split_seasons=True, qual=30)
-    all_features = []
-    all_results = []
+    games_data = load_games(start_season, end_season)
+    feature_names = generate_feature_names([stat for stat, _ in BATTER_STATS],
+                                           [stat for stat, _ in FIELDER_STATS],
+                                           [stat for stat, _ in pitcher_stats(start_season)])
+    feature_names = np.array(feature_names, dtype=np.str_)
+
+    batting_index, pitching_index = fetch_stat_indexes(start_season, end_season)
     print("Parsing game features")
-    for game_dict in tqdm(games_data["games"]):
-        game = game_from_dict(game_dict)
-        result = np.array([1 if game.home_team_won else 0])
-        features = game_to_features(game, batting_data, pitching_data,
-                                    batter_stats=[("BsR", -2.0),
-                                                  ("wRC+", 80.0)],
-                                    fielder_stats=[("Def", -4.0)],
-                                    pitcher_stats=[("FIP", replacement_fip(game.year)),
-                                                   ("BABIP", 0.305)])
-        all_features.append(features)
-        all_results.append(result)
-    feature_names = generate_feature_names(["BsR", "wRC+"], ["Def"], ["FIP", "BABIP"])
+    with stage("feature build") as record:
+        if batch:
+            # Only columns whose games or stats changed since the last build are computed
+            features = FeatureStore().build(games_data, batting_index, pitching_index,
+                                            BATTER_STATS, FIELDER_STATS, pitcher_stats, rebuild=rebuild)
+            _, _, results = games_to_id_matrix(games_data)
+        else:
+            from tqdm import tqdm
+            all_features = []
+            all_results = []
+            for game in tqdm(games_data):
+                result = np.array([1 if game.home_team_won else 0])
+                features = game_to_features(game, batting_index, pitching_index,
+                                            batter_stats=BATTER_STATS,
+                                            fielder_stats=FIELDER_STATS,
+                                            pitcher_stats=pitcher_stats(game.year))
+                all_features.append(features)
+                all_results.append(result)
+            features = np.stack(all_features, axis=0)
+            results = np.stack(all_results, axis=0)
+        record.items += len(features)
+    game_ids = games_data.columns["game_id"]
 
     print("Creating and exporting numpy data")
-    feature_names = np.array(feature_names, dtype=np.str_)
-    features = np.stack(all_features, axis=0)
-    results = np.stack(all_results, axis=0)
-    np.savez(DATASET_PATH,
-             feature_names=feature_names,
-             features=features,
-             results=results)
+    with stage("npz write") as record:
+        np.savez(DATASET_PATH,
+                 feature_names=feature_names,
+                 features=features,
+                 results=results,
+                 game_ids=game_ids)
+        record.items += len(features)
+    with stage("shard write") as record:
+        export_shards()
+        record.items += len(features)
     print("Dataset generation complete")
 
+
+def shard_path(split: str, idx: int, array: str, shard_dir: str = SHARD_DIR) -> str:
+    return os.path.join(shard_dir, f"{split}_{idx:03}_{array}.npy")
+
+
+def export_shards(seed: int = None, dataset_path: str = DATASET_PATH, shard_dir: str = SHARD_DIR):
+    # Shuffles dataset.npz once, splits it and writes fixed-width float32 shards that training can memory-map
+    with np.load(dataset_path) as data:
+        features = data["features"]
+        results = data["results"]
+    order = np.random.default_rng(seed).permutation(len(features))
+    bounds = np.cumsum([0] + [int(round(fraction*len(order))) for fraction in SPLIT_FRACTIONS.values()])
+    bounds[-1] = len(order)
+
+    os.makedirs(shard_dir, exist_ok=True)
+    for old_shard in Path(shard_dir).glob("*.npy"):
+        os.remove(old_shard)
+    for split, start, end in zip(SPLIT_FRACTIONS, bounds[:-1], bounds[1:]):
+        rows = order[start:end]
+        for idx, shard_start in enumerate(range(0, len(rows), SHARD_ROWS)):
+            shard_rows = rows[shard_start:shard_start+SHARD_ROWS]
+            np.save(shard_path(split, idx, "features", shard_dir), features[shard_rows].astype(np.float32))
+            np.save(shard_path(split, idx, "results", shard_dir), results[shard_rows].astype(np.float32))
+
+
 if __name__ == "__main__":
-    generate_numpy_dataset(2003, 2023)
+    import sys
+    # Pass --rebuild to recompute every feature column instead of reusing the feature store
+    generate_numpy_dataset(2003, 2023, rebuild="--rebuild" in sys.argv)
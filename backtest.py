@@ -0,0 +1,153 @@
+from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, TYPE_CHECKING
+import argparse
+import csv
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from acquire_data import DATASET_PATH
+from instrumentation import stage
+from odds_analytics import compare_to_market, market_metrics, print_comparison
+from odds_scraping import DIR as ODDS_DIR
+from train_model import BATCH_SIZE, import_tensorflow, generate_model
+
+if TYPE_CHECKING:
+    import tensorflow as tf
+
+
+BACKTEST_DIR = ".\\backtest"  # Memory-mappable copies of dataset.npz shared by every fold's process
+BACKTEST_REPORT_PATH = os.path.join(BACKTEST_DIR, "folds.csv")
+BACKTEST_EPOCHS = 50
+N_NEURONS = 64  # Fixed architecture, re-running the tuner for every fold would take far too long
+N_LAYERS = 3
+VALID_FRACTION = 0.2
+BASELINE_PROB = 0.54  # Same home team baseline as baseline_mse
+
+
+def backtest_path(array: str) -> str:
+    return os.path.join(BACKTEST_DIR, f"{array}.npy")
+
+
+def export_backtest_arrays(dataset_path: str = DATASET_PATH):
+    # .npz members can't be memory-mapped, so the arrays are written out once as .npy
+    if os.path.exists(backtest_path("seasons")) and os.path.getmtime(backtest_path("seasons")) >= os.path.getmtime(dataset_path):
+        return
+    os.makedirs(BACKTEST_DIR, exist_ok=True)
+    with np.load(dataset_path) as data:
+        # Retrosheet game IDs are the home team then the date, e.g. NYA200304010
+        seasons = np.array([int(game_id[3:7]) for game_id in data["game_ids"].tolist()], dtype=np.int32)
+        # Rows are kept in season order, so every fold's training set is a prefix and stays a memmap view
+        order = np.argsort(seasons, kind="stable")
+        np.save(backtest_path("features"), data["features"][order].astype(np.float32))
+        np.save(backtest_path("results"), data["results"][order].astype(np.float32))
+    np.save(backtest_path("seasons"), seasons[order])
+
+
+def memmap_dataset(features: np.ndarray, results: np.ndarray, shuffle: bool = False, seed: int = 0) -> tf.data.Dataset:
+    # Batches are read out of the memmap as they're needed, so only the shared file backs the fold's data
+    tf = import_tensorflow()
+    rng = np.random.default_rng(seed)
+
+    def batches():
+        # Rows are stored in date order, so shuffling draws every batch from a fresh permutation each epoch
+        order = rng.permutation(len(features)) if shuffle else None
+        for start in range(0, len(features), BATCH_SIZE):
+            if shuffle:
+                rows = np.sort(order[start:start+BATCH_SIZE])
+                yield features[rows], results[rows]
+            else:
+                yield features[start:start+BATCH_SIZE], results[start:start+BATCH_SIZE]
+
+    signature = (tf.TensorSpec(shape=(None, features.shape[1]), dtype=tf.float32),
+                 tf.TensorSpec(shape=(None, 1), dtype=tf.float32))
+    return tf.data.Dataset.from_generator(batches, output_signature=signature)
+
+
+def run_fold(test_season: int, threads: int, seed: int = 0) -> Dict[str, object]:
+    # Trains on every season before test_season and predicts test_season, in its own process
+    import keras_tuner as kt
+    start = time.perf_counter()
+    tf = import_tensorflow()
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    tf.keras.utils.set_random_seed(seed)
+
+    features = np.load(backtest_path("features"), mmap_mode="r")
+    results = np.load(backtest_path("results"), mmap_mode="r")
+    seasons = np.load(backtest_path("seasons"), mmap_mode="r")
+    n_train = int(np.searchsorted(seasons, test_season, side="left"))
+    n_test = int(np.searchsorted(seasons, test_season, side="right")) - n_train
+    n_valid = int(n_train*VALID_FRACTION)  # The most recent games before the test season
+    training_dataset = memmap_dataset(features[:n_train-n_valid], results[:n_train-n_valid], shuffle=True, seed=seed)
+    validation_dataset = memmap_dataset(features[n_train-n_valid:n_train], results[n_train-n_valid:n_train])
+    testing_dataset = memmap_dataset(features[n_train:n_train+n_test], results[n_train:n_train+n_test])
+
+    # Same normalization, model, optimizer and callbacks as train(), only the architecture is fixed
+    normalizer = tf.keras.layers.Normalization()
+    normalizer.adapt(training_dataset.map(lambda x, _: x))
+    training_dataset = training_dataset.map(lambda x, y: (normalizer(x), y)).prefetch(tf.data.AUTOTUNE)
+    validation_dataset = validation_dataset.map(lambda x, y: (normalizer(x), y))
+    testing_dataset = testing_dataset.map(lambda x, _: normalizer(x))
+    hp = kt.HyperParameters()
+    hp.Fixed("n_neurons", N_NEURONS)
+    hp.Fixed("n_layers", N_LAYERS)
+    model = generate_model(hp, n_features=features.shape[1])
+    lr_scheduler = tf.keras.callbacks.ReduceLROnPlateau(factor=0.5, patience=5)
+    early_stopping = tf.keras.callbacks.EarlyStopping(patience=10, restore_best_weights=True)
+    history = model.fit(training_dataset, epochs=BACKTEST_EPOCHS, validation_data=validation_dataset,
+                        callbacks=[lr_scheduler, early_stopping], verbose=0)
+    probs = model.predict(testing_dataset, verbose=0).ravel()
+    return {"season": test_season, "train_games": n_train - n_valid, "test_games": n_test,
+            "epochs": len(history.epoch), "seconds": time.perf_counter() - start,
+            "probs": probs, "outcomes": np.asarray(results[n_train:n_train+n_test]).ravel()}
+
+
+def walk_forward(workers: int = 4, min_train_seasons: int = 1) -> List[Dict[str, object]]:
+    # One fold per season after the first min_train_seasons, all training concurrently
+    export_backtest_arrays()
+    all_seasons = np.unique(np.load(backtest_path("seasons"), mmap_mode="r")).tolist()
+    test_seasons = all_seasons[min_train_seasons:]
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    context = multiprocessing.get_context("spawn")  # TensorFlow doesn't survive a fork
+    with stage("backtest") as record, ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        folds = list(executor.map(run_fold, test_seasons, [threads]*len(test_seasons)))
+        record.items += len(folds)
+    return folds
+
+
+def fold_report(folds: List[Dict[str, object]]):
+    seasons = np.concatenate([np.full(fold["test_games"], fold["season"]) for fold in folds])
+    probs = np.concatenate([fold["probs"] for fold in folds])
+    outcomes = np.concatenate([fold["outcomes"] for fold in folds])
+    if os.path.isdir(ODDS_DIR):
+        market = market_metrics()
+    else:
+        market = {"season": np.array([], dtype=int), "brier": np.array([]), "log_loss": np.array([])}
+    comparison = compare_to_market(seasons, probs, outcomes, market)
+    print_comparison(comparison)
+
+    baseline = np.bincount(np.unique(seasons, return_inverse=True)[1], weights=(outcomes-BASELINE_PROB)**2)
+    skill = 1 - comparison["brier"] / (baseline / comparison["n"])
+    market_skill = 1 - comparison["market_brier"] / (baseline / comparison["n"])
+    os.makedirs(BACKTEST_DIR, exist_ok=True)
+    with open(BACKTEST_REPORT_PATH, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["season", "train_games", "test_games", "epochs", "seconds", "skill", "market_skill"])
+        print(f"{'season':>6} {'train':>7} {'epochs':>6} {'seconds':>8} {'skill':>7} {'market':>7}")
+        for fold, fold_skill, fold_market_skill in zip(folds, skill, market_skill):
+            writer.writerow([fold["season"], fold["train_games"], fold["test_games"], fold["epochs"],
+                             f"{fold['seconds']:.2f}", fold_skill, fold_market_skill])
+            print(f"{fold['season']:>6} {fold['train_games']:>7} {fold['epochs']:>6} {fold['seconds']:>8.1f} "
+                  f"{fold_skill:>7.4f} {fold_market_skill:>7.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4, help="folds trained at once")
+    parser.add_argument("--min-train-seasons", type=int, default=1)
+    args = parser.parse_args()
+    fold_report(walk_forward(args.workers, args.min_train_seasons))
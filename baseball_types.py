@@ -1,8 +1,14 @@
 from dataclasses import dataclass, field
 from io import StringIO
+from typing import Dict, Iterable, Iterator, List
+import os
 
-@dataclass
+import numpy as np
+
+@dataclass(slots=True)
 class Game:
+    game_id: str = ""  # Retrosheet game ID, home team + date + game number
+
     year: int = 0
     month: int = 0
     day: int = 0
@@ -28,6 +34,70 @@ class Game:
     home_team_won: bool = True
 
 
+class GameTable:
+    # Struct-of-arrays storage for many games, one NumPy column per Game field
+    # Column name -> (dtype, width), a width of 0 means a scalar per game
+    COLUMNS = {"game_id": ("<U12", 0),
+               "year": (np.int32, 0), "month": (np.int32, 0), "day": (np.int32, 0), "game_number": (np.int32, 0),
+               "home_team": ("<U3", 0), "away_team": ("<U3", 0),
+               "home_wins": (np.int32, 0), "home_losses": (np.int32, 0),
+               "away_wins": (np.int32, 0), "away_losses": (np.int32, 0),
+               "home_lineup": (np.int32, 9), "away_lineup": (np.int32, 9),
+               "home_defense": (np.int32, 8), "away_defense": (np.int32, 8),
+               "home_starter": (np.int32, 0), "away_starter": (np.int32, 0),
+               "home_team_won": (np.bool_, 0)}
+
+    def __init__(self, columns: Dict[str, np.ndarray]):
+        self.columns = columns
+
+    @classmethod
+    def from_games(cls, games: Iterable[Game]) -> "GameTable":
+        values = {name: [] for name in cls.COLUMNS}
+        for game in games:
+            for name in cls.COLUMNS:
+                values[name].append(getattr(game, name))
+        columns = {}
+        for name, (dtype, width) in cls.COLUMNS.items():
+            columns[name] = np.array(values[name], dtype=dtype)
+            if width > 0:
+                columns[name] = columns[name].reshape(-1, width)
+        return cls(columns)
+
+    @classmethod
+    def concatenate(cls, tables: List["GameTable"]) -> "GameTable":
+        return cls({name: np.concatenate([table.columns[name] for table in tables]) for name in cls.COLUMNS})
+
+    @classmethod
+    def exists(cls, path: str) -> bool:
+        return all(os.path.exists(os.path.join(path, f"{name}.npy")) for name in cls.COLUMNS)
+
+    @classmethod
+    def load(cls, path: str) -> "GameTable":
+        return cls({name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in cls.COLUMNS})
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        for name, column in self.columns.items():
+            np.save(os.path.join(path, f"{name}.npy"), column)
+
+    def __len__(self) -> int:
+        return len(self.columns["year"])
+
+    def __getitem__(self, idx: int) -> Game:
+        game = Game()
+        for name, (_, width) in self.COLUMNS.items():
+            value = self.columns[name][idx]
+            setattr(game, name, value.tolist() if width > 0 else value.item())
+        return game
+
+    def __iter__(self) -> Iterator[Game]:
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def to_games(self) -> List[Game]:
+        return list(self)
+
+
 @dataclass
 class OddsOutcome:
     home_line: int = 0
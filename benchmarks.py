@@ -0,0 +1,355 @@
+from __future__ import annotations
+from baseball_types import Game, GameTable
+from event_log_parser import iter_event_file, tokenize_event_file, find_win_loss, game_player_ids, PlayerIdResolver
+from acquire_data import StatIndex, build_feature_matrix, game_to_features, games_to_id_matrix, export_shards, \
+    BATTER_STATS, FIELDER_STATS, SPLIT_FRACTIONS, pitcher_stats
+from odds_scraping import parse_odds_page
+from rolling_stats import iter_snapshots
+from instrumentation import REPORT
+from typing import Callable, Iterator, List, Tuple, TYPE_CHECKING
+from dataclasses import dataclass
+from copy import deepcopy
+from pathlib import Path
+import synthetic_data
+import argparse
+import itertools
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pytest
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+def measure(fn: Callable, *args) -> Tuple[object, float, int]:
+    # Returns the result, wall time in seconds and peak traced memory in bytes
+    # Pipeline stages reset tracemalloc's peak, so the call runs as a stage too to collect their peaks
+    tracemalloc.start()
+    with REPORT.stage("benchmark") as record:
+        record.peak_memory_mb = 0.0
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+    tracemalloc.stop()
+    return result, elapsed, int(record.peak_memory_mb*1e6)
+
+
+def best_time(fn: Callable, repeats: int) -> float:
+    # Timing without tracemalloc, which slows down allocation-heavy code
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def random_games(n_games: int, seed: int = 0) -> List[Game]:
+    rng = random.Random(seed)
+    games = []
+    for _ in range(n_games):
+        game = Game(year=rng.randint(2003, 2023), month=rng.randint(4, 9), day=rng.randint(1, 28),
+                    home_team="NYA", away_team="BOS", home_team_won=rng.random() < 0.54)
+        game.home_lineup = [rng.randint(1, 30000) for _ in range(9)]
+        game.away_lineup = [rng.randint(1, 30000) for _ in range(9)]
+        game.home_defense = [rng.randint(1, 30000) for _ in range(8)]
+        game.away_defense = [rng.randint(1, 30000) for _ in range(8)]
+        game.home_starter = rng.randint(1, 30000)
+        game.away_starter = rng.randint(1, 30000)
+        games.append(game)
+    return games
+
+
+def bench_game_table(n_games: int = 100000):
+    games = random_games(n_games)
+    # Copying the list measures the full cost of the Game objects and their inner lists
+    _, list_time, list_peak = measure(deepcopy, games)
+    table, table_time, table_peak = measure(GameTable.from_games, games)
+    round_trip, round_trip_time, _ = measure(table.to_games)
+    table_bytes = sum(column.nbytes for column in table.columns.values())
+    assert round_trip == games
+
+    print(f"GameTable vs List[Game] ({n_games} games)")
+    print(f"  List[Game]: copy {list_time:.3f}s, peak {list_peak/1e6:.1f} MB")
+    print(f"  GameTable:  build {table_time:.3f}s, peak {table_peak/1e6:.1f} MB, resident {table_bytes/1e6:.1f} MB")
+    print(f"  GameTable -> List[Game]: {round_trip_time:.3f}s")
+
+
+def startswith_parse_event_file(path: str) -> Iterator[Game]:
+    # The line-by-line startswith chain iter_event_file used before tokenize_event_file, kept as a reference
+    with open(path, 'r') as file:
+        current_game: Game = None
+        winning_pitcher = ""  # Keep track of these because for some reason the log doesn't say who won
+
+        for line in file:
+            if line.startswith("id"):
+                current_game = Game(game_id=line[3:].strip())
+
+            elif line.startswith("info,date"):
+                current_game.year = int(line[10:14])
+                current_game.month = int(line[15:17])
+                current_game.day = int(line[18:20])
+
+            elif line.startswith("info,number"):
+                current_game.game_number = int(line[-2])
+
+            elif line.startswith("info,wp"):
+                winning_pitcher = line[8:].strip()
+
+            elif line.startswith("info,visteam"):
+                current_game.away_team = line[13:].strip()
+
+            elif line.startswith("info,hometeam"):
+                current_game.home_team = line[14:].strip()
+
+            elif line.startswith("start"):
+                # Parse out relevant info
+                player_info = line.split(",")
+                retro_id = player_info[1]
+                home = player_info[3]=="1"
+                lineup_position = int(player_info[4])
+                field_position = int(player_info[5])
+
+                # Check if this player is the winning pitcher
+                if retro_id == winning_pitcher:
+                    current_game.home_team_won = home
+
+                # Put player ID into required spots in lineup and defense
+                if home:
+                    if field_position == 1:
+                        current_game.home_starter = retro_id
+                    elif field_position > 1 and field_position < 10:
+                        current_game.home_defense[field_position-2] = retro_id
+                    if lineup_position > 0:
+                        current_game.home_lineup[lineup_position-1] = retro_id
+                else:
+                    if field_position == 1:
+                        current_game.away_starter = retro_id
+                    elif field_position > 1 and field_position < 10:
+                        current_game.away_defense[field_position-2] = retro_id
+                    if lineup_position > 0:
+                        current_game.away_lineup[lineup_position-1] = retro_id
+
+            elif line.startswith("sub"):
+                # We need this logic to figure out who the winning pitcher plays for
+                player_info = line.split(",")
+                if player_info[1] == winning_pitcher:
+                    current_game.home_team_won = player_info[3]=="1"
+
+            elif line.startswith("data") and current_game is not None:
+                yield current_game
+                current_game = None
+                winning_pitcher = ""
+
+
+def bench_event_parser(path: str, repeats: int = 5):
+    size = os.path.getsize(path)
+    with open(path, "r") as file:
+        n_lines = sum(1 for _ in file)
+    assert list(startswith_parse_event_file(path)) == list(iter_event_file(path))
+
+    print(f"Event file parsing ({os.path.basename(path)}: {n_lines} lines, {size/1e6:.2f} MB)")
+    cases = [("startswith chain", lambda: list(startswith_parse_event_file(path))),
+             ("tokenizer only", lambda: sum(1 for _ in tokenize_event_file(path))),
+             ("tokenizer + parse", lambda: list(iter_event_file(path)))]
+    for name, fn in cases:
+        best = best_time(fn, repeats)
+        print(f"  {name:<18} {n_lines/best:>12,.0f} lines/s {size/1e6/best:>8.1f} MB/s")
+
+
+def import_time(module: str) -> float:
+    # Fresh interpreter per module so nothing is already cached in sys.modules
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(result.stdout) if result.returncode == 0 else float("nan")
+
+
+def bench_imports():
+    print("Import times")
+    for module in ["baseball_types", "event_log_parser", "acquire_data", "odds_scraping", "odds_analytics",
+                   "predict", "train_model", "cli"]:
+        print(f"  {module:<18} {import_time(module):6.3f}s")
+    # What the pipeline modules used to pull in at import time
+    for module in ["pandas", "pybaseball", "tqdm", "selenium.webdriver", "bs4", "tensorflow", "keras_tuner"]:
+        print(f"  {module:<18} {import_time(module):6.3f}s (dependency)")
+
+
+BENCH_SEASONS = int(os.environ.get("BENCH_SEASONS", 1))  # Scale of the synthetic fixtures, 1 to 50 seasons
+BENCH_TEAMS = int(os.environ.get("BENCH_TEAMS", len(synthetic_data.TEAMS)))
+BENCH_ROUNDS = 3
+
+
+@dataclass
+class PipelineFixture:
+    workdir: str
+    start_season: int
+    end_season: int
+    register_path: str
+    cache_path: str
+    games: List[Game]  # Retrosheet IDs, straight out of the parser
+    retro_ids: List[str]
+    resolved_games: List[Game]
+    table: GameTable
+    batting_data: pd.DataFrame
+    pitching_data: pd.DataFrame
+    batting_index: StatIndex
+    pitching_index: StatIndex
+    odds_files: List[str]
+    shard_dir: str
+
+
+@pytest.fixture(scope="module")
+def pipeline(tmp_path_factory) -> PipelineFixture:
+    # Every stage's inputs, built once from synthetic data so no network or real data is needed
+    workdir = str(tmp_path_factory.mktemp("pipeline"))
+    start_season, end_season = 2003, 2003 + BENCH_SEASONS - 1
+    files = synthetic_data.write_event_files(os.path.join(workdir, "events"), start_season, BENCH_SEASONS, BENCH_TEAMS)
+    register_path = os.path.join(workdir, "people.csv")
+    synthetic_data.write_register(register_path, BENCH_TEAMS)
+    games = [game for file in files for game in iter_event_file(file)]
+    retro_ids = [retro_id for game in games for retro_id in game_player_ids(game)]
+
+    cache_path = os.path.join(workdir, "player_ids.csv")
+    resolver = PlayerIdResolver(cache_path=cache_path, register_path=register_path)
+    resolver.resolve(retro_ids)
+    resolved_games = [game for file in files for game in iter_event_file(file)]
+    for game in resolved_games:
+        resolver.translate(game)
+    find_win_loss(resolved_games)
+
+    batting_data, pitching_data = synthetic_data.stat_tables(start_season, BENCH_SEASONS, BENCH_TEAMS)
+    odds_files = synthetic_data.write_odds_pages(os.path.join(workdir, "odds"), start_season, BENCH_SEASONS,
+                                                 pages_per_season=10)
+    dataset_path = os.path.join(workdir, "dataset.npz")
+    shard_dir = os.path.join(workdir, "dataset")
+    synthetic_data.write_dataset(dataset_path, len(games))
+    export_shards(dataset_path=dataset_path, shard_dir=shard_dir)
+    return PipelineFixture(workdir=workdir, start_season=start_season, end_season=end_season,
+                           register_path=register_path, cache_path=cache_path, games=games, retro_ids=retro_ids,
+                           resolved_games=resolved_games, table=GameTable.from_games(resolved_games),
+                           batting_data=batting_data, pitching_data=pitching_data,
+                           batting_index=StatIndex(batting_data, ["BsR", "wRC+", "Def"]),
+                           pitching_index=StatIndex(pitching_data, ["FIP", "BABIP"]),
+                           odds_files=odds_files, shard_dir=shard_dir)
+
+
+def run_case(benchmark, fn: Callable, n_items: int, unit: str, setup: Callable[[], tuple] = None):
+    # pytest-benchmark does the timing, one extra traced run adds peak memory and throughput to the saved results
+    _, seconds, peak = measure(fn, *(setup() if setup is not None else ()))
+    benchmark.extra_info.update({"items": n_items, "unit": unit, "peak_mb": peak/1e6})
+    if setup is None:
+        result = benchmark.pedantic(fn, rounds=BENCH_ROUNDS, iterations=1)
+    else:
+        result = benchmark.pedantic(fn, setup=lambda: (setup(), {}), rounds=BENCH_ROUNDS, iterations=1)
+    benchmark.extra_info[f"{unit}_per_second"] = n_items / benchmark.stats.stats.min
+    return result
+
+
+def test_parse_event_files(benchmark, pipeline: PipelineFixture):
+    files = sorted(Path(pipeline.workdir, "events").glob("*.EVA"))
+    run_case(benchmark, lambda: [game for file in files for game in iter_event_file(file)],
+             len(pipeline.games), "games")
+
+
+def test_resolve_ids_register(benchmark, pipeline: PipelineFixture):
+    # Every ID is looked up in the register, each round starts from an empty cache file
+    cache_paths = (os.path.join(pipeline.workdir, f"cold_ids_{idx}.csv") for idx in itertools.count())
+    run_case(benchmark, lambda resolver: resolver.resolve(pipeline.retro_ids), len(pipeline.retro_ids), "ids",
+             setup=lambda: (PlayerIdResolver(cache_path=next(cache_paths), register_path=pipeline.register_path),))
+
+
+def test_resolve_ids_cached(benchmark, pipeline: PipelineFixture):
+    # A fresh resolver reading the cache file the fixture wrote, nothing is looked up
+    run_case(benchmark, lambda resolver: resolver.resolve(pipeline.retro_ids), len(pipeline.retro_ids), "ids",
+             setup=lambda: (PlayerIdResolver(cache_path=pipeline.cache_path),))
+
+
+def test_rolling_snapshots(benchmark, pipeline: PipelineFixture):
+    events_dir = os.path.join(pipeline.workdir, "events")
+    run_case(benchmark, lambda: list(iter_snapshots(events_dir, pipeline.start_season, pipeline.end_season)),
+             len(pipeline.games), "games")
+
+
+def test_find_win_loss(benchmark, pipeline: PipelineFixture):
+    seasons = {}
+    for game in pipeline.resolved_games:
+        seasons.setdefault(game.year, []).append(game)
+    run_case(benchmark, lambda: [find_win_loss(season_games) for season_games in seasons.values()],
+             len(pipeline.resolved_games), "games")
+
+
+def test_game_table_from_games(benchmark, pipeline: PipelineFixture):
+    run_case(benchmark, lambda: GameTable.from_games(pipeline.resolved_games), len(pipeline.resolved_games), "games")
+
+
+def test_stat_index_build(benchmark, pipeline: PipelineFixture):
+    run_case(benchmark, lambda: (StatIndex(pipeline.batting_data, ["BsR", "wRC+", "Def"]),
+                                 StatIndex(pipeline.pitching_data, ["FIP", "BABIP"])),
+             len(pipeline.batting_data) + len(pipeline.pitching_data), "rows")
+
+
+def test_build_feature_matrix(benchmark, pipeline: PipelineFixture):
+    player_ids, seasons, _ = games_to_id_matrix(pipeline.table)
+    run_case(benchmark, lambda: build_feature_matrix(player_ids, seasons, pipeline.batting_index,
+                                                     pipeline.pitching_index, BATTER_STATS, FIELDER_STATS,
+                                                     pitcher_stats),
+             len(player_ids), "games")
+
+
+def test_game_to_features(benchmark, pipeline: PipelineFixture):
+    sample = pipeline.resolved_games[:2000]
+    run_case(benchmark, lambda: [game_to_features(game, pipeline.batting_index, pipeline.pitching_index, BATTER_STATS,
+                                                  FIELDER_STATS, pitcher_stats(game.year)) for game in sample],
+             len(sample), "games")
+
+
+def test_parse_odds_pages(benchmark, pipeline: PipelineFixture):
+    pytest.importorskip("lxml")
+    pages = []
+    for path in pipeline.odds_files:
+        with open(path, "r", encoding="utf-16") as file:
+            pages.append(file.read())
+    outcomes = run_case(benchmark, lambda: [outcome for html in pages for outcome in parse_odds_page(html)],
+                        len(pages)*50, "games")
+    assert len(outcomes) == len(pages)*50
+
+
+def test_prep_dataset_epoch(benchmark, pipeline: PipelineFixture):
+    # Normalizer adapt plus one pass over the training shards
+    pytest.importorskip("tensorflow")
+    from train_model import prep_dataset, import_tensorflow
+    tf = import_tensorflow()
+
+    def one_epoch():
+        training_dataset, _, _ = prep_dataset(tf.keras.layers.Normalization(), shard_dir=pipeline.shard_dir)
+        return sum(int(x.shape[0]) for x, _ in training_dataset)
+    run_case(benchmark, one_epoch, int(len(pipeline.games)*SPLIT_FRACTIONS["train"]), "rows")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("event_files", nargs="*", help="real event files to compare the parsers on")
+    parser.add_argument("--seasons", type=int, default=1, help="synthetic seasons to generate (1-50)")
+    parser.add_argument("--teams", type=int, default=len(synthetic_data.TEAMS))
+    parser.add_argument("--imports", action="store_true", help="also measure module import times")
+    parser.add_argument("-k", default=None, help="only run the stage cases matching this pytest expression")
+    args = parser.parse_args()
+
+    if args.imports:
+        bench_imports()
+    bench_game_table()
+    with tempfile.TemporaryDirectory() as workdir:
+        paths = args.event_files or synthetic_data.write_event_files(workdir, 2003, 1, n_teams=2)[:1]
+        for path in paths:
+            bench_event_parser(path)
+    # The stage cases are pytest-benchmark tests, so they can also be run, selected and compared with pytest directly
+    os.environ["BENCH_SEASONS"] = str(args.seasons)
+    os.environ["BENCH_TEAMS"] = str(args.teams)
+    sys.exit(pytest.main([__file__, "-q"] + (["-k", args.k] if args.k else [])))
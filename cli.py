@@ -0,0 +1,82 @@
+import argparse
+import os
+import tracemalloc
+
+from instrumentation import REPORT
+
+
+RUN_REPORT_DIR = ".\\reports"
+
+
+# Every subcommand imports only the modules it needs, so e.g. an odds report never loads TensorFlow
+def main():
+    parser = argparse.ArgumentParser(prog="baseball-ml")
+    parser.add_argument("--profile", action="store_true", help="write a cProfile dump per pipeline stage")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="trace Python allocations so each stage reports its own peak memory, slows the run down; "
+                             "without it a stage only reports how far it raised the process's peak RSS")
+    parser.add_argument("--offline", action="store_true", help="only use cached stats, fail instead of fetching")
+    parser.add_argument("--report", default=None, help="run report path without extension, defaults to reports/<command>")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parse = subparsers.add_parser("parse", help="parse event files into the per-season game store")
+    parse.add_argument("start_season", type=int)
+    parse.add_argument("end_season", type=int)
+
+    build = subparsers.add_parser("build-dataset", help="build dataset.npz and its training shards")
+    build.add_argument("start_season", type=int)
+    build.add_argument("end_season", type=int)
+    build.add_argument("--rebuild", action="store_true", help="recompute every feature column in the feature store")
+
+    train = subparsers.add_parser("train", help="tune and train a model")
+    train.add_argument("--cpu", action="store_true", help="run tuner trials in parallel CPU worker processes")
+    train.add_argument("--workers", type=int, default=4, help="number of trial workers in --cpu mode")
+
+    backtest = subparsers.add_parser("backtest", help="walk-forward backtest, one fold per season")
+    backtest.add_argument("--workers", type=int, default=4, help="folds trained at once")
+    backtest.add_argument("--min-train-seasons", type=int, default=1)
+
+    odds = subparsers.add_parser("odds-report", help="bookmaker MSE per season from the scraped odds pages")
+    odds.add_argument("--workers", type=int, default=None)
+
+    export = subparsers.add_parser("export-model", help="export a saved model for NumPy inference")
+    export.add_argument("model_path")
+    export.add_argument("out_path")
+
+    args = parser.parse_args()
+    REPORT.profile = args.profile
+    if args.trace_memory:
+        tracemalloc.start()
+    if args.offline:
+        import stat_cache
+        stat_cache.OFFLINE = True
+    if args.command == "parse":
+        from acquire_data import load_games
+        games = load_games(args.start_season, args.end_season)
+        print(f"{len(games)} games cached")
+    elif args.command == "build-dataset":
+        from acquire_data import generate_numpy_dataset
+        generate_numpy_dataset(args.start_season, args.end_season, rebuild=args.rebuild)
+    elif args.command == "train":
+        from train_model import train
+        train(cpu=args.cpu, workers=args.workers)
+    elif args.command == "backtest":
+        from backtest import walk_forward, fold_report
+        fold_report(walk_forward(args.workers, args.min_train_seasons))
+    elif args.command == "odds-report":
+        from odds_analytics import odds_report
+        odds_report(args.workers)
+    elif args.command == "export-model":
+        from predict import export_numpy_model
+        export_numpy_model(args.model_path, args.out_path)
+
+    # Stage timings, counts, cache hit rates and memory, for comparing runs
+    report_path = args.report or os.path.join(RUN_REPORT_DIR, args.command)
+    os.makedirs(os.path.dirname(report_path) or ".", exist_ok=True)
+    REPORT.write_json(report_path + ".json")
+    REPORT.write_csv(report_path + ".csv")
+    REPORT.print_summary()
+
+
+if __name__ == "__main__":
+    main()
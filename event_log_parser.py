@@ -1,193 +1,236 @@
-from baseball_types import Game, NullIO
-from typing import List, Dict, Tuple, Iterable
+from baseball_types import Game
+from instrumentation import stage
+from typing import List, Dict, Iterable, Iterator
 
-from copy import deepcopy
 from pathlib import Path
-import datetime
-import sys
-from tqdm import tqdm
-import pandas as pd
-from pybaseball import playerid_reverse_lookup, schedule_and_record, team_ids
-
-
-def parse_event_file(path: str, cached_ids: Dict[str, int] = {}) -> List[Game]:
-    games = []
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import os
+
+
+PLAYER_ID_CACHE_PATH = ".\\player_ids.csv"
+
+
+def game_player_ids(game: Game) -> List:
+    return game.home_lineup + game.away_lineup + game.home_defense + game.away_defense + [game.home_starter, game.away_starter]
+
+
+class PlayerIdResolver:
+    # Maps Retrosheet IDs to FanGraphs IDs, persisting every answer so later runs don't query again
+    def __init__(self, cache_path: str = PLAYER_ID_CACHE_PATH, register_path: str = None):
+        self.cache_path = cache_path
+        self.register_path = register_path  # Local Chadwick register (people.csv) for offline use
+        self.ids: Dict[str, int] = {}
+        if os.path.exists(cache_path):
+            with open(cache_path, "r", newline="") as file:
+                for row in csv.DictReader(file):
+                    self.ids[row["key_retro"]] = int(row["key_fangraphs"])
+
+    def resolve(self, retro_ids: Iterable[str]):
+        with stage("id lookup") as record:
+            retro_ids = set(retro_ids)
+            unknown_retro_ids = sorted(retro_ids - self.ids.keys())
+            record.items += len(retro_ids)
+            record.cache_hits += len(retro_ids) - len(unknown_retro_ids)
+            record.cache_misses += len(unknown_retro_ids)
+            if len(unknown_retro_ids) > 0:
+                self.lookup(unknown_retro_ids)
+
+    def lookup(self, unknown_retro_ids: List[str]):
+        # Looks up IDs missing from the cache and appends the answers to it
+        if self.register_path is not None:
+            import pandas as pd
+            player_id_table = pd.read_csv(self.register_path, usecols=["key_retro", "key_fangraphs"])
+            player_id_table = player_id_table[player_id_table["key_retro"].isin(unknown_retro_ids)]
+        else:
+            from pybaseball import playerid_reverse_lookup
+            player_id_table = playerid_reverse_lookup(unknown_retro_ids, key_type="retro")
+        player_id_table = player_id_table.fillna({"key_fangraphs": -1})
+        found = dict(zip(player_id_table["key_retro"], player_id_table["key_fangraphs"]))
+
+        new_file = not os.path.exists(self.cache_path)
+        with open(self.cache_path, "a", newline="") as file:
+            writer = csv.writer(file)
+            if new_file:
+                writer.writerow(["key_retro", "key_fangraphs"])
+            for retro_id in unknown_retro_ids:
+                fgid = int(found.get(retro_id, -1))  # -1 matches pybaseball's marker for players FanGraphs lacks
+                self.ids[retro_id] = fgid
+                writer.writerow([retro_id, fgid])
+
+    def translate(self, game: Game):
+        # Replace Retrosheet ID's with FanGraph ID's
+        for idx, retro_id in enumerate(game.home_lineup):
+            game.home_lineup[idx] = self.ids[retro_id]
+        for idx, retro_id in enumerate(game.away_lineup):
+            game.away_lineup[idx] = self.ids[retro_id]
+        for idx, retro_id in enumerate(game.home_defense):
+            game.home_defense[idx] = self.ids[retro_id]
+        for idx, retro_id in enumerate(game.away_defense):
+            game.away_defense[idx] = self.ids[retro_id]
+        game.home_starter = self.ids[game.home_starter]
+        game.away_starter = self.ids[game.away_starter]
+
+
+PARSED_RECORDS = ("id", "info", "start", "sub", "data")
+
+
+def tokenize_event_file(path: str, records: Iterable[str] = PARSED_RECORDS) -> Iterator[List[str]]:
+    # Yields the comma separated fields of the wanted record types only
+    # Most lines are play records, so lines are rejected on their first character before any splitting
+    records = set(records)
+    first_chars = {record[0] for record in records}
     with open(path, 'r') as file:
-        current_game: Game = None
-        winning_pitcher = ""  # Keep track of these because for some reason the log doesn't say who won
-        unknown_retro_ids = []
-
-        for line in file:
-            if line.startswith("id"):
-                current_game = Game()
-
-            elif line.startswith("info,date"):
-                current_game.year = int(line[10:14])
-                current_game.month = int(line[15:17])
-                current_game.day = int(line[18:20])
-
-            elif line.startswith("info,number"):
-                current_game.game_number = int(line[-2])
-
-            elif line.startswith("info,wp"):
-                winning_pitcher = line[8:].strip()
-
+        text = file.read()
+    for line in text.splitlines():
+        if line[:1] not in first_chars:
+            continue
+        fields = line.split(",")
+        if fields[0] in records:
+            yield fields
+
+
+def iter_event_file(path: str) -> Iterator[Game]:
+    # Yields each game as soon as its data lines start, player slots hold Retrosheet IDs
+    current_game: Game = None
+    winning_pitcher = ""  # Keep track of these because for some reason the log doesn't say who won
+
+    for fields in tokenize_event_file(path):
+        record = fields[0]
+        if record == "id":
+            current_game = Game(game_id=fields[1])
+
+        elif record == "info":
+            key = fields[1]
+            if key == "date":
+                year, month, day = fields[2].split("/")
+                current_game.year = int(year)
+                current_game.month = int(month)
+                current_game.day = int(day)
+            elif key == "number":
+                current_game.game_number = int(fields[2])
+            elif key == "wp":
+                winning_pitcher = fields[2].strip()
             # Use the teams and date info later to determine team records
-            # Not doing it as part of this function to cut down on web queries
-            elif line.startswith("info,visteam"):
-                current_game.away_team = line[13:].strip()
-
-            elif line.startswith("info,hometeam"):
-                current_game.home_team = line[14:].strip()
-
-            elif line.startswith("start"):
-                # Parse out relevant info
-                player_info = line.split(",")
-                retro_id = player_info[1]
-                home = player_info[3]=="1"
-                lineup_position = int(player_info[4])
-                field_position = int(player_info[5])
-
-                # Check if this player is the winning pitcher
-                if retro_id == winning_pitcher:
-                    current_game.home_team_won = home
-
-                # Determine if we need to query pybaseball for FanGraphs ID
-                if retro_id not in cached_ids:
-                    unknown_retro_ids.append(retro_id)
-
-                # Put player ID into required spots in lineup and defense
-                if home:
-                    if field_position == 1:
-                        current_game.home_starter = retro_id
-                    elif field_position > 1 and field_position < 10:
-                        current_game.home_defense[field_position-2] = retro_id
-                    if lineup_position > 0:
-                        current_game.home_lineup[lineup_position-1] = retro_id
-                else:
-                    if field_position == 1:
-                        current_game.away_starter = retro_id
-                    elif field_position > 1 and field_position < 10:
-                        current_game.away_defense[field_position-2] = retro_id
-                    if lineup_position > 0:
-                        current_game.away_lineup[lineup_position-1] = retro_id
-
-            elif line.startswith("sub"):
-                # We need this logic to figure out who the winning pitcher plays for
-                player_info = line.split(",")
-                if player_info[1] == winning_pitcher:
-                    current_game.home_team_won = player_info[3]=="1"
-
-            elif line.startswith("data") and current_game is not None:
-                # This is our indicator for the end of the game
-                # Don't count on hitting another ID because not applicable for last game in file
-                
-                # Query FanGraph ID's for our unknown players and add them to the cache
-                player_id_table = playerid_reverse_lookup(unknown_retro_ids, key_type="retro")
-                for retro_id in unknown_retro_ids:
-                    fgid = player_id_table.loc[player_id_table["key_retro"]==retro_id]["key_fangraphs"].item()
-                    cached_ids[retro_id] = fgid
-                
-                # Replace Retrosheet ID's with FanGraph ID's
-                for idx, retro_id in enumerate(current_game.home_lineup):
-                    current_game.home_lineup[idx] = cached_ids[retro_id]
-                for idx, retro_id in enumerate(current_game.away_lineup):
-                    current_game.away_lineup[idx] = cached_ids[retro_id]
-                for idx, retro_id in enumerate(current_game.home_defense):
-                    current_game.home_defense[idx] = cached_ids[retro_id]
-                for idx, retro_id in enumerate(current_game.away_defense):
-                    current_game.away_defense[idx] = cached_ids[retro_id]
-                current_game.home_starter = cached_ids[current_game.home_starter]
-                current_game.away_starter = cached_ids[current_game.away_starter]
-
-                games.append(deepcopy(current_game))
-                current_game = None
-                winning_pitcher = ""
-                unknown_retro_ids = []
+            elif key == "visteam":
+                current_game.away_team = fields[2].strip()
+            elif key == "hometeam":
+                current_game.home_team = fields[2].strip()
+
+        elif record == "start":
+            # Parse out relevant info
+            retro_id = fields[1]
+            home = fields[3]=="1"
+            lineup_position = int(fields[4])
+            field_position = int(fields[5])
+
+            # Check if this player is the winning pitcher
+            if retro_id == winning_pitcher:
+                current_game.home_team_won = home
+
+            # Put player ID into required spots in lineup and defense
+            if home:
+                if field_position == 1:
+                    current_game.home_starter = retro_id
+                elif field_position > 1 and field_position < 10:
+                    current_game.home_defense[field_position-2] = retro_id
+                if lineup_position > 0:
+                    current_game.home_lineup[lineup_position-1] = retro_id
+            else:
+                if field_position == 1:
+                    current_game.away_starter = retro_id
+                elif field_position > 1 and field_position < 10:
+                    current_game.away_defense[field_position-2] = retro_id
+                if lineup_position > 0:
+                    current_game.away_lineup[lineup_position-1] = retro_id
+
+        elif record == "sub":
+            # We need this logic to figure out who the winning pitcher plays for
+            if fields[1] == winning_pitcher:
+                current_game.home_team_won = fields[3]=="1"
+
+        elif record == "data" and current_game is not None:
+            # This is our indicator for the end of the game
+            # Don't count on hitting another ID because not applicable for last game in file
+            # Every id line creates a fresh Game, so there is nothing to copy
+            yield current_game
+            current_game = None
+            winning_pitcher = ""
+
+
+def parse_event_file(path: str, resolver: PlayerIdResolver = None) -> List[Game]:
+    # Player slots hold Retrosheet IDs unless a resolver is given
+    games = list(iter_event_file(path))
+    if resolver is not None:
+        resolver.resolve(retro_id for game in games for retro_id in game_player_ids(game))
+        for game in games:
+            resolver.translate(game)
     return games
 
 
-def datestring(game: Game) -> str:
-    date = datetime.datetime(game.year, game.month, game.day)
-    out = date.strftime("%A, %b %d").replace(" 0", " ")
-    if game.game_number != 0:
-        out += f" ({game.game_number})"
-    return out
+def find_win_loss(games: List[Game]):
+    # Each team's record before a game is just the running count of the games it already played
+    # Sorting on game_number puts the first game of a doubleheader before the second
+    with stage("record lookup") as record:
+        games.sort(key=lambda game: (game.year, game.month, game.day, game.game_number))
+        records: Dict[str, List[int]] = {}
+        for game in games:
+            home_record = records.setdefault(game.home_team, [0, 0])
+            away_record = records.setdefault(game.away_team, [0, 0])
+            game.home_wins, game.home_losses = home_record
+            game.away_wins, game.away_losses = away_record
+            if game.home_team_won:
+                home_record[0] += 1
+                away_record[1] += 1
+            else:
+                home_record[1] += 1
+                away_record[0] += 1
+        record.items += len(games)
+
+
+def parse_event_files(files: List[Path], resolver: PlayerIdResolver, executor: ProcessPoolExecutor = None,
+                      desc: str = None) -> List[Game]:
+    from tqdm import tqdm
+    # Workers only parse, ID resolution happens afterwards in this process
+    with stage("event parsing") as record:
+        parsed = map(parse_event_file, files) if executor is None else executor.map(parse_event_file, files)
+        games = []
+        for file_games in tqdm(parsed, desc=desc, total=len(files), unit="file", ncols=80):
+            games.extend(file_games)
+        record.items += len(games)
+
+    # Resolve all the files in one lookup instead of one per game
+    with stage("id resolution") as record:
+        resolver.resolve(retro_id for game in games for retro_id in game_player_ids(game))
+        for game in games:
+            resolver.translate(game)
+        record.items += len(games)
+    return games
 
 
-def parse_record_table(df: pd.DataFrame) -> Tuple[int, int]:
-    # df is a one row DataFrame wth columns: Date, W/L, W-L
-    try:
-        won_game = df["W/L"].item().startswith("W")
-    except Exception as e:
-        print(df)
-        raise e
-    wins, losses = [int(n) for n in df["W-L"].item().split("-")]
-    if won_game:
-        wins -= 1
-    else:
-        losses -= 1
-    return wins, losses
-
-
-def find_win_loss(games: List[Game], team_ids_cache: Dict[str, str]):
-    cached_schedule_tables = {}
-    team_id_lut = team_ids(season=games[0].year)
-    silencer = NullIO()
-    for game in tqdm(games, unit="game", ncols=80):
-        for team in [game.home_team, game.away_team]:
-            if team not in cached_schedule_tables:
-                if game.year <= 2021:  # pybaseball team ID has data through 2021
-                    br_team_id = team_id_lut[team_id_lut["teamIDretro"]==team]["teamIDBR"].item()
-                    team_ids_cache[team] = br_team_id
-                elif team in team_ids_cache:  # hope they didn't change between 2021 and 2023 :shrug:
-                    br_team_id = team_ids_cache[team]
-                else:
-                    br_team_id = team
-
-                sys.stdout = silencer
-                tbl: pd.DataFrame = schedule_and_record(game.year, br_team_id)
-                sys.stdout = sys.__stdout__
-
-                tbl = tbl[["Date", "W/L", "W-L"]]
-                cached_schedule_tables[team] = tbl
-
-        date = datestring(game)
-        home_table = cached_schedule_tables[game.home_team]
-        home_table = home_table[home_table["Date"]==date]
-        w, l = parse_record_table(home_table)
-        game.home_wins = w
-        game.home_losses = l
-
-        away_table = cached_schedule_tables[game.away_team]
-        away_table = away_table[away_table["Date"]==date]
-        w, l = parse_record_table(away_table)
-        game.away_wins = w
-        game.away_losses = l
-
-
-def count_files(iter: Iterable) -> int:
-    # Vanity helper function for prettier progress bars
-    n = 0
-    for _ in iter:
-        n += 1
-    return n
-
-
-def parse_events_directory(path: str, start_season: int, end_season: int) -> List[Game]:
+def iter_games(path: str, start_season: int, end_season: int,
+               resolver: PlayerIdResolver = None, workers: int = 1) -> Iterator[Game]:
+    # Only one season is held in memory at a time, records need the whole season before it can be yielded
     dir = Path(path)
-    all_games = []
-    player_ids = {}
-    team_id_cache = {}
-    for year in range(start_season, end_season+1):
-        year_games = []
-        n_files = count_files(dir.glob(f"{year}*"))
-        for file in tqdm(dir.glob(f"{year}*"), desc=str(year), total=n_files, unit="file", ncols=80):
-            games = parse_event_file(file, cached_ids=player_ids)
-            year_games.extend(games)
-        find_win_loss(year_games, team_id_cache)
-        all_games.extend(year_games)
-    return all_games
+    if resolver is None:
+        resolver = PlayerIdResolver()
+
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        for year in range(start_season, end_season+1):
+            # Sorted so results are merged in the same order regardless of worker count
+            files = sorted(dir.glob(f"{year}*"))
+            year_games = parse_event_files(files, resolver, executor, desc=str(year))
+            find_win_loss(year_games)
+            yield from year_games
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def parse_events_directory(path: str, start_season: int, end_season: int,
+                           resolver: PlayerIdResolver = None, workers: int = 1) -> List[Game]:
+    return list(iter_games(path, start_season, end_season, resolver=resolver, workers=workers))
 
 
 if __name__ == "__main__":
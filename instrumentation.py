@@ -0,0 +1,122 @@
+from dataclasses import dataclass, asdict, fields
+from typing import Dict, Iterator
+import contextlib
+import cProfile
+import csv
+import json
+import os
+import time
+import tracemalloc
+
+try:
+    import resource  # Not available on Windows
+except ImportError:
+    resource = None
+
+
+PROFILE_DIR = ".\\profiles"
+
+
+@dataclass
+class StageRecord:
+    name: str
+    calls: int = 0
+    seconds: float = 0.0
+    items: int = 0
+    cache_hits: int = 0
+    cache_misses: int = 0
+    peak_memory_mb: float = 0.0
+
+    @property
+    def items_per_second(self) -> float:
+        return self.items / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def cache_hit_rate(self) -> float:
+        lookups = self.cache_hits + self.cache_misses
+        return self.cache_hits / lookups if lookups > 0 else 0.0
+
+
+def peak_rss_mb() -> float:
+    # The process's peak RSS where the OS reports it, it can only ever grow
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3  # ru_maxrss is in KB on Linux
+    return 0.0
+
+
+class RunReport:
+    # Collects per-stage timings and counters for one run of the pipeline
+    def __init__(self):
+        self.stages: Dict[str, StageRecord] = {}
+        self.profile = False  # Dump a cProfile of each top level stage to PROFILE_DIR
+        self.profiling = False
+        self.child_peaks = []  # Traced peak of each open stage's finished children, since they reset the peak
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[StageRecord]:
+        record = self.stages.setdefault(name, StageRecord(name))
+        # Only one profiler can be active, so stages nested in a profiled stage show up inside its profile
+        profiler = None
+        if self.profile and not self.profiling:
+            profiler = cProfile.Profile()
+            self.profiling = True
+            profiler.enable()
+        # Memory is the stage's own peak above what was in use when it started. With tracemalloc that's exact,
+        # otherwise it's how far the stage pushed up the process's peak RSS
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if self.child_peaks:
+                self.child_peaks[-1] = max(self.child_peaks[-1], peak)
+            self.child_peaks.append(0)
+            tracemalloc.reset_peak()
+        else:
+            start_rss = peak_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.seconds += time.perf_counter() - start
+            record.calls += 1
+            if tracing:
+                peak = max(self.child_peaks.pop(), tracemalloc.get_traced_memory()[1])
+                if self.child_peaks:
+                    self.child_peaks[-1] = max(self.child_peaks[-1], peak)
+                stage_peak = (peak - current) / 1e6
+            else:
+                stage_peak = peak_rss_mb() - start_rss
+            record.peak_memory_mb = max(record.peak_memory_mb, stage_peak)
+            if profiler is not None:
+                profiler.disable()
+                self.profiling = False
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                profiler.dump_stats(os.path.join(PROFILE_DIR, f"{name.replace(' ', '_')}.prof"))
+
+    def rows(self) -> list:
+        return [dict(asdict(record), items_per_second=record.items_per_second, cache_hit_rate=record.cache_hit_rate)
+                for record in self.stages.values()]
+
+    def write_json(self, path: str):
+        with open(path, "w") as file:
+            json.dump(self.rows(), file, indent=2)
+
+    def write_csv(self, path: str):
+        columns = [f.name for f in fields(StageRecord)] + ["items_per_second", "cache_hit_rate"]
+        with open(path, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(self.rows())
+
+    def print_summary(self):
+        print(f"{'stage':<16} {'seconds':>9} {'items':>9} {'items/s':>11} {'hit rate':>8} {'peak MB':>8}")
+        for record in self.stages.values():
+            print(f"{record.name:<16} {record.seconds:>9.2f} {record.items:>9} {record.items_per_second:>11.0f} "
+                  f"{record.cache_hit_rate:>8.2f} {record.peak_memory_mb:>8.0f}")
+
+
+# The pipeline modules all record into this report
+REPORT = RunReport()
+
+
+def stage(name: str) -> contextlib.AbstractContextManager:
+    return REPORT.stage(name)
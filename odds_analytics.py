@@ -0,0 +1,101 @@
+from typing import Dict, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from odds_scraping import odds_pages, load_odds_page
+
+
+N_BUCKETS = 10  # Calibration buckets of width 0.1
+EPSILON = 1e-15  # Keeps log loss finite for 0/1 predictions
+
+
+def load_odds(workers: int = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # Returns seasons, home lines, away lines and home wins for every scraped game
+    pages = odds_pages()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        parsed = list(executor.map(load_odds_page, [path for _, path in pages], chunksize=8))
+    seasons = np.concatenate([np.full(len(home_lines), year) for (year, _), (home_lines, _, _) in zip(pages, parsed)])
+    home_lines = np.concatenate([home_lines for home_lines, _, _ in parsed]).astype(np.float64)
+    away_lines = np.concatenate([away_lines for _, away_lines, _ in parsed]).astype(np.float64)
+    home_wins = np.concatenate([home_wins for _, _, home_wins in parsed])
+    return seasons, home_lines, away_lines, home_wins
+
+
+def implied_probabilities(lines: np.ndarray) -> np.ndarray:
+    # Moneyline -> bookmaker probability, still including the vig
+    lines = np.asarray(lines, dtype=np.float64)
+    return np.where(lines > 0, 100/(100+lines), -lines/(100-lines))
+
+
+def market_probabilities(home_lines: np.ndarray, away_lines: np.ndarray) -> np.ndarray:
+    # Home win probability with the vig removed by normalizing the pair, same as lines_to_pcts
+    home_pct = implied_probabilities(home_lines)
+    away_pct = implied_probabilities(away_lines)
+    return home_pct / (home_pct + away_pct)
+
+
+def season_metrics(seasons: np.ndarray, probs: np.ndarray, outcomes: np.ndarray) -> Dict[str, np.ndarray]:
+    # Brier score (the MSE we've been reporting), log loss and calibration buckets for every season at once
+    season_values, season_idx = np.unique(seasons, return_inverse=True)
+    probs = np.asarray(probs, dtype=np.float64).ravel()
+    outcomes = np.asarray(outcomes, dtype=np.float64).ravel()
+    n = np.bincount(season_idx)
+
+    clipped = np.clip(probs, EPSILON, 1-EPSILON)
+    brier = np.bincount(season_idx, weights=(probs-outcomes)**2) / n
+    log_loss = -np.bincount(season_idx, weights=outcomes*np.log(clipped) + (1-outcomes)*np.log(1-clipped)) / n
+
+    bucket = np.minimum((probs*N_BUCKETS).astype(int), N_BUCKETS-1)
+    cell = season_idx*N_BUCKETS + bucket
+    size = len(season_values)*N_BUCKETS
+    bucket_count = np.bincount(cell, minlength=size).reshape(-1, N_BUCKETS)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        bucket_predicted = np.bincount(cell, weights=probs, minlength=size).reshape(-1, N_BUCKETS) / bucket_count
+        bucket_observed = np.bincount(cell, weights=outcomes, minlength=size).reshape(-1, N_BUCKETS) / bucket_count
+
+    return {"season": season_values, "n": n, "brier": brier, "log_loss": log_loss,
+            "bucket_count": bucket_count, "bucket_predicted": bucket_predicted, "bucket_observed": bucket_observed}
+
+
+def overall_metrics(metrics: Dict[str, np.ndarray]) -> Tuple[float, float]:
+    # Game-weighted Brier and log loss across all seasons
+    n = metrics["n"]
+    return float(np.sum(metrics["brier"]*n) / np.sum(n)), float(np.sum(metrics["log_loss"]*n) / np.sum(n))
+
+
+def market_metrics(workers: int = None) -> Dict[str, np.ndarray]:
+    seasons, home_lines, away_lines, home_wins = load_odds(workers)
+    return season_metrics(seasons, market_probabilities(home_lines, away_lines), home_wins)
+
+
+def odds_report(workers: int = None):
+    metrics = market_metrics(workers)
+    for season, brier, log_loss in zip(metrics["season"], metrics["brier"], metrics["log_loss"]):
+        print(f"{season}: MSE={brier:5}, log loss={log_loss:5}")
+    brier, log_loss = overall_metrics(metrics)
+    print(f"Overall: MSE={brier:5}, log loss={log_loss:5}")
+
+
+def compare_to_market(seasons: np.ndarray, model_probs: np.ndarray, outcomes: np.ndarray,
+                      market: Dict[str, np.ndarray] = None) -> Dict[str, np.ndarray]:
+    # The odds pages don't identify teams or dates, so the model is compared against the market season by season
+    model = season_metrics(seasons, model_probs, outcomes)
+    if market is None:
+        market = market_metrics()
+    market_brier = dict(zip(market["season"].tolist(), market["brier"].tolist()))
+    market_log_loss = dict(zip(market["season"].tolist(), market["log_loss"].tolist()))
+    model["market_brier"] = np.array([market_brier.get(season, np.nan) for season in model["season"].tolist()])
+    model["market_log_loss"] = np.array([market_log_loss.get(season, np.nan) for season in model["season"].tolist()])
+    return model
+
+
+def print_comparison(comparison: Dict[str, np.ndarray]):
+    print(f"{'season':>6} {'games':>6} {'model MSE':>10} {'market MSE':>10} {'model LL':>9} {'market LL':>9}")
+    for season, n, brier, market_brier, log_loss, market_log_loss in zip(
+            comparison["season"], comparison["n"], comparison["brier"], comparison["market_brier"],
+            comparison["log_loss"], comparison["market_log_loss"]):
+        print(f"{season:>6} {n:>6} {brier:>10.5f} {market_brier:>10.5f} {log_loss:>9.5f} {market_log_loss:>9.5f}")
+
+
+if __name__ == "__main__":
+    odds_report()
@@ -1,14 +1,18 @@
-from typing import List, Tuple
+from __future__ import annotations
+from typing import Dict, List, Tuple, TYPE_CHECKING
 from baseball_types import OddsOutcome
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from urllib.request import urlopen
+import queue
+import threading
 import time
 import os
-from tqdm import tqdm
+import numpy as np
 
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.wait import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from bs4 import BeautifulSoup
+# selenium, lxml and tqdm are imported where they're used so reading cached pages doesn't pay for them
+if TYPE_CHECKING:
+    from selenium import webdriver
 
 import re
 
@@ -16,23 +20,111 @@ import re
 ODDS_BOX_CLASS = "next-m:min-w-[80%] next-m:min-h-[26px] next-m:max-h-[26px] flex cursor-pointer items-center justify-center font-bold hover:border hover:border-orange-main min-w-[50px] min-h-[50px]"
 DATA_TABLE_CLASS = "flex flex-col px-3 text-sm max-mm:px-0"
 DIR = "C:\\Users\\lplab\\Documents\\Retrosheet\\odds"
+PARSED_DIR = os.path.join(DIR, "parsed")  # Parsed lines per page, keyed by the page's mtime
 BASE_URL = "https://www.oddsportal.com/baseball/usa/"
 
 
-# Website I'm using has a delay that prevents `requests` from working
+class RateLimiter:
+    # Spaces out requests to the same host across all fetcher threads
+    def __init__(self, min_interval: float = 1.0):
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.next_slot: Dict[str, float] = {}
+
+    def wait(self, url: str):
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.min_interval
+        time.sleep(slot - now)
+
+
+class OddsLoaded:
+    # The results table renders before its odds are filled in, so wait until the odds box count stops changing
+    def __init__(self):
+        self.last_count = -1
+
+    def __call__(self, driver) -> bool:
+        from selenium.webdriver.common.by import By
+        count = len(driver.find_elements(By.CSS_SELECTOR, f"[class='{ODDS_BOX_CLASS}']"))
+        loaded = count > 0 and count == self.last_count
+        self.last_count = count
+        return loaded
+
+
+# Website I'm using has a delay that prevents `requests` from working, so pages are rendered with Selenium
+class SeleniumFetcher:
+    def __init__(self, pool_size: int = 4, rate_limiter: RateLimiter = None, timeout: float = 20):
+        self.pool_size = pool_size
+        self.rate_limiter = RateLimiter() if rate_limiter is None else rate_limiter
+        self.timeout = timeout
+        self.idle_drivers = queue.Queue()
+        self.all_drivers = []
+        self.lock = threading.Lock()
+
+    def acquire(self) -> webdriver.Chrome:
+        # Drivers are started lazily and reused, at most pool_size are ever alive
+        from selenium import webdriver
+        with self.lock:
+            if self.idle_drivers.empty() and len(self.all_drivers) < self.pool_size:
+                driver = webdriver.Chrome()
+                self.all_drivers.append(driver)
+                return driver
+        return self.idle_drivers.get()
+
+    def fetch(self, url: str) -> str:
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.wait import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+        self.rate_limiter.wait(url)
+        driver = self.acquire()
+        try:
+            # Pages only differ by the URL fragment, so start from a blank page to force a real load
+            driver.get("about:blank")
+            driver.get(url)
+            WebDriverWait(driver, self.timeout).until(
+                EC.presence_of_element_located((By.CSS_SELECTOR, f"[class='{DATA_TABLE_CLASS}']"))
+            )
+            WebDriverWait(driver, self.timeout).until(OddsLoaded())
+            return driver.page_source
+        finally:
+            self.idle_drivers.put(driver)
+
+    def close(self):
+        for driver in self.all_drivers:
+            driver.quit()
+        self.all_drivers = []
+        self.idle_drivers = queue.Queue()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class HttpFetcher:
+    # Plain HTTP backend for a local stand-in server serving saved pages
+    # URL fragments never reach a server, so "#/page/N/" is sent as part of the path instead
+    def __init__(self, rate_limiter: RateLimiter = None):
+        self.rate_limiter = RateLimiter(0.0) if rate_limiter is None else rate_limiter
+
+    def fetch(self, url: str) -> str:
+        self.rate_limiter.wait(url)
+        with urlopen(url.replace("#/", "")) as response:
+            return response.read().decode(response.headers.get_content_charset() or "utf-8")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
 def grab_html(url: str):
-    driver = webdriver.Chrome()
-    driver.get(url)
-    html = ""
-    try:
-        _ = WebDriverWait(driver, 10).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, f"[class='{DATA_TABLE_CLASS}']"))
-        )
-        time.sleep(5)  # not happy about needing the fudge factor, but it is what it is
-        html = driver.page_source
-    finally:
-        driver.quit()
-    return html
+    with SeleniumFetcher(pool_size=1) as fetcher:
+        return fetcher.fetch(url)
 
 
 def available_years(html: str) -> List[str]:
@@ -55,19 +147,21 @@ def lines_to_pcts(line1: int, line2: int) -> Tuple[float, float]:
 
 
 def parse_odds_page(html: str) -> List[OddsOutcome]:
-    soup = BeautifulSoup(html, "html.parser")
-    odds_boxes = soup.find_all(class_=ODDS_BOX_CLASS)
+    # Only the odds boxes matter, so select them directly from lxml's tree
+    from lxml import html as lxml_html
+    tree = lxml_html.fromstring(html)
+    odds_boxes = tree.xpath(f"//*[@class='{ODDS_BOX_CLASS}']")
     it = iter(odds_boxes)
     outcomes = []
 
     for box in it:
         outcome = OddsOutcome()
-        box_home = next(box.children)
-        box_away = next(next(it).children)
+        box_home = box[0]
+        box_away = next(it)[0]
 
-        outcome.home_team_won = "gradient-green" in box_home["class"]
-        home_line = int(box_home.text)
-        away_line = int(box_away.text)
+        outcome.home_team_won = "gradient-green" in box_home.get("class", "").split()
+        home_line = int(box_home.text_content())
+        away_line = int(box_away.text_content())
         home_pct, away_pct = lines_to_pcts(home_line, away_line)
         outcome.home_implied_odds = home_pct
         outcome.home_line = home_line
@@ -78,56 +172,60 @@ def parse_odds_page(html: str) -> List[OddsOutcome]:
     return outcomes
 
 
-def walk_odds_site():
+def load_odds_page(path: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Returns home lines, away lines and whether the home team won, reparsing only if the page changed
+    cache_path = os.path.join(PARSED_DIR, os.path.basename(path) + ".npz")
+    mtime = os.path.getmtime(path)
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            if cached["mtime"] == mtime:
+                return cached["home_line"], cached["away_line"], cached["home_team_won"]
+
+    with open(path, "r", encoding="utf-16") as file:
+        html = file.read()
+    outcomes = parse_odds_page(html)
+    home_line = np.array([outcome.home_line for outcome in outcomes], dtype=np.int16)
+    away_line = np.array([outcome.away_line for outcome in outcomes], dtype=np.int16)
+    home_team_won = np.array([outcome.home_team_won for outcome in outcomes], dtype=np.bool_)
+    os.makedirs(PARSED_DIR, exist_ok=True)
+    np.savez(cache_path, mtime=mtime, home_line=home_line, away_line=away_line, home_team_won=home_team_won)
+    return home_line, away_line, home_team_won
+
+
+def odds_pages() -> List[Tuple[int, str]]:
+    pages = []
+    for filename in sorted(os.listdir(DIR)):
+        path = os.path.join(DIR, filename)
+        if os.path.isfile(path) and filename.endswith(".html"):
+            pages.append((int(filename.split("_")[1]), path))
+    return pages
+
+
+def walk_odds_site(fetcher=None, base_url: str = BASE_URL, workers: int = 4):
+    from tqdm import tqdm
     if not os.path.exists(DIR):
         os.makedirs(DIR)
-    html = grab_html(BASE_URL + "mlb/results/")
-    years = available_years(html)
-    for year in years:
-        html = grab_html(BASE_URL + f"mlb-{year}/results/")
-        n_pages = last_page(html)
-        # In hindsight, I could do this by having Selenium click the next button
-        # But I can also just run this while I sleep
-        for i in range(n_pages):
-            fname = f"odds_{year}_{i+1:02}.html"
-            if os.path.exists(os.path.join(DIR, fname)):
-                continue
-            else:
-                html = grab_html(BASE_URL + f"mlb-{year}/results/#/page/{i+1}/")
-                with open(os.path.join(DIR, fname), "w", encoding="utf-16") as file:
-                    file.write(html)
+    if fetcher is None:
+        fetcher = SeleniumFetcher(pool_size=workers)
+
+    def save_page(year: str, page: int):
+        html = fetcher.fetch(base_url + f"mlb-{year}/results/#/page/{page}/")
+        with open(os.path.join(DIR, f"odds_{year}_{page:02}.html"), "w", encoding="utf-16") as file:
+            file.write(html)
+
+    with fetcher, ThreadPoolExecutor(max_workers=workers) as executor:
+        html = fetcher.fetch(base_url + "mlb/results/")
+        years = available_years(html)
+        for year in years:
+            html = fetcher.fetch(base_url + f"mlb-{year}/results/")
+            n_pages = last_page(html)
+            pages = [i+1 for i in range(n_pages) if not os.path.exists(os.path.join(DIR, f"odds_{year}_{i+1:02}.html"))]
+            # Each year's pages are fetched concurrently, the rate limiter keeps us polite to the host
+            for _ in tqdm(executor.map(lambda page: save_page(year, page), pages), desc=year, total=len(pages)):
+                pass
 
 
 if __name__ == "__main__":
     # walk_odds_site()
-    yearly_book_success = {}
-
-    for filename in tqdm(os.listdir(DIR)):
-        path = os.path.join(DIR, filename)
-        if not os.path.isfile(path):
-            continue
-
-        year = int(filename.split("_")[1])
-        with open(path, "r", encoding="utf-16") as file:
-            html = file.read()
-        results = parse_odds_page(html)
-
-        n_events = 0
-        sum_square_error = 0
-        for result in results:
-            n_events += 1
-            sum_square_error += (1-result.home_implied_odds)**2 if result.home_team_won else (1-result.away_implied_odds)**2
-
-        if year not in yearly_book_success:
-            yearly_book_success[year] = [n_events, sum_square_error]
-        else:
-            yearly_book_success[year][0] += n_events
-            yearly_book_success[year][1] += sum_square_error
-
-    total_sse = 0
-    total_n = 0
-    for year, (n, sse) in yearly_book_success.items():
-        total_sse += sse
-        total_n += n
-        print(f"{year}: MSE={sse/n:5}")
-    print(f"Overall: MSE={total_sse/total_n:5}")
\ No newline at end of file
+    from odds_analytics import odds_report
+    odds_report()
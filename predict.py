@@ -0,0 +1,93 @@
+from baseball_types import Game, GameTable
+from typing import List
+from acquire_data import (fetch_stat_indexes, games_to_id_matrix, build_feature_matrix,
+                          BATTER_STATS, FIELDER_STATS, pitcher_stats)
+import argparse
+import numpy as np
+
+
+SELU_ALPHA = 1.6732632423543772
+SELU_SCALE = 1.0507009873554805
+KERAS_EPSILON = 1e-7  # Normalization divides by max(sqrt(variance), epsilon)
+
+
+def export_numpy_model(model_path: str, out_path: str):
+    # Dumps the Normalization + Dense weights of a saved model so NumpyModel can run it without TensorFlow
+    import tensorflow as tf
+    model = tf.keras.models.load_model(model_path)
+
+    def flatten(layer):
+        if hasattr(layer, "layers"):
+            for sublayer in layer.layers:
+                yield from flatten(sublayer)
+        else:
+            yield layer
+
+    weights = {}
+    activations = []
+    for layer in flatten(model):
+        if isinstance(layer, tf.keras.layers.Normalization):
+            weights["mean"], weights["variance"] = [np.ravel(w) for w in layer.get_weights()[:2]]
+        elif isinstance(layer, tf.keras.layers.Dense):
+            kernel, bias = layer.get_weights()
+            weights[f"kernel_{len(activations)}"] = kernel
+            weights[f"bias_{len(activations)}"] = bias
+            activations.append(layer.get_config()["activation"])
+    np.savez(out_path, activations=np.array(activations, dtype=np.str_), **weights)
+
+
+class NumpyModel:
+    # Forward pass of the normalized dense SELU stack from train_model in plain NumPy
+    def __init__(self, path: str):
+        with np.load(path) as data:
+            self.mean = data["mean"].astype(np.float32)
+            self.scale = np.maximum(np.sqrt(data["variance"]), KERAS_EPSILON).astype(np.float32)
+            self.activations = data["activations"].tolist()
+            self.kernels = [data[f"kernel_{i}"] for i in range(len(self.activations))]
+            self.biases = [data[f"bias_{i}"] for i in range(len(self.activations))]
+
+    def __call__(self, features: np.ndarray) -> np.ndarray:
+        x = (features - self.mean) / self.scale
+        for kernel, bias, activation in zip(self.kernels, self.biases, self.activations):
+            x = x @ kernel + bias
+            if activation == "selu":
+                x = SELU_SCALE * np.where(x > 0, x, SELU_ALPHA * np.expm1(np.minimum(x, 0)))
+            elif activation == "sigmoid":
+                x = 1 / (1 + np.exp(-x))
+            elif activation != "linear":
+                raise ValueError(f"Unsupported activation {activation}")
+        return x
+
+
+class KerasModel:
+    def __init__(self, path: str):
+        import tensorflow as tf
+        self.model = tf.keras.models.load_model(path)
+
+    def __call__(self, features: np.ndarray) -> np.ndarray:
+        return self.model(features, training=False).numpy()
+
+
+class Predictor:
+    # Loads the model and the season's stat index once, then scores batches of games
+    def __init__(self, model_path: str, season: int):
+        self.model = NumpyModel(model_path) if model_path.endswith(".npz") else KerasModel(model_path)
+        self.batting_index, self.pitching_index = fetch_stat_indexes(season, season)
+
+    def features(self, games: List[Game]) -> np.ndarray:
+        # Same feature layout as generate_numpy_dataset
+        player_ids, seasons, _ = games_to_id_matrix(GameTable.from_games(games))
+        return build_feature_matrix(player_ids, seasons, self.batting_index, self.pitching_index,
+                                    BATTER_STATS, FIELDER_STATS, pitcher_stats)
+
+    def predict(self, games: List[Game]) -> np.ndarray:
+        # Home team win probability for each game
+        return self.model(self.features(games).astype(np.float32)).ravel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_path", help="saved .keras model")
+    parser.add_argument("out_path", help="where to write the NumPy weights (.npz)")
+    args = parser.parse_args()
+    export_numpy_model(args.model_path, args.out_path)
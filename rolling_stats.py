@@ -0,0 +1,273 @@
+from contextlib import ExitStack
+from dataclasses import dataclass
+from instrumentation import stage
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Tuple
+import sys
+
+import numpy as np
+
+
+ROLLING_STATS_PATH = ".\\rolling_stats.npz"
+ROLLING_RECORDS = ("id", "info", "start", "sub", "play", "data")
+
+# FanGraphs style linear weights and FIP constant, close enough for every season we use
+WOBA_WEIGHTS = {"BB": 0.69, "HBP": 0.72, "1B": 0.88, "2B": 1.25, "3B": 1.58, "HR": 2.03}
+FIP_CONSTANT = 3.10
+LEAGUE_WOBA = 0.315
+LEAGUE_FIP = 4.20
+LEAGUE_ERA = 4.20
+PRIOR_PA = 200  # How many plate appearances the prior is worth
+PRIOR_INNINGS = 50.0
+
+# Plays where nobody bats, i.e. baserunning and pitches that don't end the plate appearance
+NO_PLATE_APPEARANCE = ("NP", "BK", "CS", "DI", "OA", "PB", "WP", "PO", "SB", "FLE")
+
+# Counter slots, kept in plain lists since they're bumped one at a time
+B_PA, B_AB, B_BB, B_IBB, B_HBP, B_1B, B_2B, B_3B, B_HR, B_SF, B_K = range(11)
+P_BF, P_OUTS, P_K, P_BB, P_HBP, P_HR, P_ER = range(7)
+BATTER_COUNTS = {"BB": (B_PA, B_BB), "IBB": (B_PA, B_IBB), "HBP": (B_PA, B_HBP), "1B": (B_PA, B_AB, B_1B),
+                 "2B": (B_PA, B_AB, B_2B), "3B": (B_PA, B_AB, B_3B), "HR": (B_PA, B_AB, B_HR), "K": (B_PA, B_AB, B_K),
+                 "OUT": (B_PA, B_AB), "SF": (B_PA, B_SF), "SH": (B_PA,), "CI": (B_PA,)}
+PITCHER_COUNTS = {"BB": (P_BF, P_BB), "IBB": (P_BF, P_BB), "HBP": (P_BF, P_HBP), "HR": (P_BF, P_HR), "K": (P_BF, P_K)}
+
+
+def batter_outcome(play: str, modifiers: List[str]) -> str:
+    # What the plate appearance counts as, or "" if the play wasn't the end of one
+    if play.startswith(NO_PLATE_APPEARANCE):
+        return ""
+    if play.startswith("HP"):
+        return "HBP"
+    if play.startswith("H"):
+        return "HR"
+    if play.startswith("I"):
+        return "IBB"
+    if play.startswith("W"):
+        return "BB"
+    if play.startswith("K"):
+        return "K"
+    if play.startswith("C"):
+        return "CI"
+    if play.startswith("S"):
+        return "1B"
+    if play.startswith("D"):
+        return "2B"
+    if play.startswith("T"):
+        return "3B"
+    if "SF" in modifiers:
+        return "SF"
+    if "SH" in modifiers:
+        return "SH"
+    return "OUT"  # Balls in play, errors and fielder's choices are all at bats without a hit
+
+
+def play_outs(play: str, advances: str) -> int:
+    outs = 0
+    for part in play.split("+"):
+        if part.startswith(("CS", "PO")):
+            outs += "E" not in part
+        elif part.startswith("K"):
+            outs += "B-" not in advances  # Batter reached on a dropped third strike
+        elif part[:1].isdigit() and "E" not in part:
+            # e.g. 63 is one out, 64(1)3 is two and 64(1) leaves the batter on first
+            outs += part.count("(") + (not part.endswith(")"))
+    for advance in advances.split(";"):
+        # e.g. 1X3(56), unless the parenthesis has an error that let the runner reach
+        if advance[1:2] == "X":
+            outs += "E" not in advance
+    return outs
+
+
+@dataclass(slots=True)
+class Snapshot:
+    # Stats of the game's starters using only games played before it, in the same slot order as Game
+    game_id: str
+    woba: List[float]  # Home lineup then away lineup
+    plate_appearances: List[int]
+    fip: List[float]  # Home starter then away starter
+    era: List[float]
+    innings: List[float]
+
+
+class RollingStats:
+    # Running counters for the current season, with each player's final rates from last season as priors
+    def __init__(self):
+        self.batting: Dict[str, List[int]] = {}
+        self.pitching: Dict[str, List[int]] = {}
+        self.woba_priors: Dict[str, float] = {}
+        self.fip_priors: Dict[str, float] = {}
+        self.era_priors: Dict[str, float] = {}
+
+    def woba(self, player: str) -> float:
+        prior = self.woba_priors.get(player, LEAGUE_WOBA)
+        counts = self.batting.get(player)
+        if counts is None:
+            return prior
+        value = (WOBA_WEIGHTS["BB"]*counts[B_BB] + WOBA_WEIGHTS["HBP"]*counts[B_HBP] + WOBA_WEIGHTS["1B"]*counts[B_1B]
+                 + WOBA_WEIGHTS["2B"]*counts[B_2B] + WOBA_WEIGHTS["3B"]*counts[B_3B] + WOBA_WEIGHTS["HR"]*counts[B_HR])
+        denominator = counts[B_AB] + counts[B_BB] + counts[B_SF] + counts[B_HBP]
+        return (value + prior*PRIOR_PA) / (denominator + PRIOR_PA)
+
+    def plate_appearances(self, player: str) -> int:
+        counts = self.batting.get(player)
+        return 0 if counts is None else counts[B_PA]
+
+    def innings(self, player: str) -> float:
+        counts = self.pitching.get(player)
+        return 0.0 if counts is None else counts[P_OUTS] / 3
+
+    def fip(self, player: str) -> float:
+        prior = self.fip_priors.get(player, LEAGUE_FIP)
+        counts = self.pitching.get(player)
+        if counts is None:
+            return prior
+        value = 13*counts[P_HR] + 3*(counts[P_BB] + counts[P_HBP]) - 2*counts[P_K]
+        return (value + (prior - FIP_CONSTANT)*PRIOR_INNINGS) / (counts[P_OUTS]/3 + PRIOR_INNINGS) + FIP_CONSTANT
+
+    def era(self, player: str) -> float:
+        prior = self.era_priors.get(player, LEAGUE_ERA)
+        counts = self.pitching.get(player)
+        if counts is None:
+            return prior
+        return (9*counts[P_ER] + prior*PRIOR_INNINGS) / (counts[P_OUTS]/3 + PRIOR_INNINGS)
+
+    def new_season(self):
+        # The blended rates already lean on the older priors, so they fade out over the seasons
+        self.woba_priors.update({player: self.woba(player) for player in self.batting})
+        self.fip_priors.update({player: self.fip(player) for player in self.pitching})
+        self.era_priors.update({player: self.era(player) for player in self.pitching})
+        self.batting = {}
+        self.pitching = {}
+
+    def play(self, batter: str, pitcher: str, event: str):
+        basic, _, advances = event.partition(".")
+        play, *modifiers = basic.split("/")
+        outcome = batter_outcome(play, modifiers)
+        pitching = self.pitching.get(pitcher)
+        if pitching is None:
+            pitching = self.pitching[pitcher] = [0]*7
+        if outcome:
+            batting = self.batting.get(batter)
+            if batting is None:
+                batting = self.batting[batter] = [0]*11
+            for idx in BATTER_COUNTS[outcome]:
+                batting[idx] += 1
+            for idx in PITCHER_COUNTS.get(outcome, (P_BF,)):
+                pitching[idx] += 1
+        pitching[P_OUTS] += play_outs(play, advances)
+
+    def snapshot(self, game_id: str, lineups: Dict[str, List[str]], pitchers: Dict[str, str]) -> Snapshot:
+        batters = lineups["1"] + lineups["0"]
+        starters = [pitchers["1"], pitchers["0"]]
+        return Snapshot(game_id=game_id,
+                        woba=[self.woba(player) for player in batters],
+                        plate_appearances=[self.plate_appearances(player) for player in batters],
+                        fip=[self.fip(player) for player in starters],
+                        era=[self.era(player) for player in starters],
+                        innings=[self.innings(player) for player in starters])
+
+    def game(self, records: Iterable[List[str]]) -> Snapshot:
+        # The snapshot is taken once the lineups are known and before the first play counts
+        lineups = {"0": [""]*9, "1": [""]*9}
+        pitchers = {"0": "", "1": ""}
+        game_id = ""
+        snapshot = None
+        for fields in records:
+            record = fields[0]
+            if record == "id":
+                game_id = fields[1]
+            elif record == "start" or record == "sub":
+                side, spot, position = fields[3], int(fields[4]), int(fields[5])
+                if position == 1:
+                    pitchers[side] = fields[1]
+                if snapshot is None and spot > 0:
+                    lineups[side][spot-1] = fields[1]
+            elif record == "play":
+                if snapshot is None:
+                    snapshot = self.snapshot(game_id, lineups, pitchers)
+                fielding = "0" if fields[2] == "1" else "1"
+                self.play(fields[3], pitchers[fielding], fields[6])
+            elif record == "data" and fields[1] == "er":
+                if snapshot is None:
+                    snapshot = self.snapshot(game_id, lineups, pitchers)
+                self.pitching.setdefault(fields[2], [0]*7)[P_ER] += int(fields[3])
+        if snapshot is None:
+            snapshot = self.snapshot(game_id, lineups, pitchers)
+        return snapshot
+
+
+def index_games(files: List[Path]) -> List[Tuple[str, int, int, int]]:
+    # (date, number, file, byte offset of the id record) for every game, without keeping any of its records
+    index = []
+    for file_idx, file in enumerate(files):
+        with open(file, "rb") as handle:
+            offset = 0
+            for line in handle:
+                if line.startswith(b"id,"):
+                    index.append(["", 0, file_idx, offset])
+                elif line.startswith(b"info,") and len(index) > 0 and index[-1][2] == file_idx:
+                    fields = line.rstrip(b"\r\n").split(b",")
+                    if fields[1] == b"date":
+                        index[-1][0] = fields[2].decode()
+                    elif fields[1] == b"number":
+                        index[-1][1] = int(fields[2])
+                offset += len(line)
+    # Dates are zero padded, so they sort as strings, and the sort is stable for games with the same key
+    index.sort(key=lambda entry: (entry[0], entry[1]))
+    return [tuple(entry) for entry in index]
+
+
+def game_records(handle: BinaryIO, offset: int) -> Iterator[List[str]]:
+    # The comma separated fields of one game's wanted records, read from its id record up to the next game's
+    handle.seek(offset)
+    for idx, line in enumerate(handle):
+        fields = line.decode("latin-1").rstrip("\r\n").split(",")
+        if fields[0] == "id" and idx > 0:
+            return
+        if fields[0] in ROLLING_RECORDS:
+            yield fields
+
+
+def season_games(files: List[Path]) -> Iterator[Iterator[List[str]]]:
+    # Event files are per home team, so the season's games are replayed in the order they were played,
+    # reading each one straight from its file so only the index of games is kept in memory
+    index = index_games(files)
+    with ExitStack() as stack:
+        handles = [stack.enter_context(open(file, "rb")) for file in files]
+        for _, _, file_idx, offset in index:
+            yield game_records(handles[file_idx], offset)
+
+
+def iter_snapshots(path: str, start_season: int, end_season: int) -> Iterator[Snapshot]:
+    # One chronological pass, every play is a constant time counter update
+    stats = RollingStats()
+    for season in range(start_season, end_season+1):
+        for records in season_games(sorted(Path(path).glob(f"{season}*"))):
+            yield stats.game(records)
+        stats.new_season()
+
+
+def rolling_table(path: str, start_season: int, end_season: int) -> Dict[str, np.ndarray]:
+    # Snapshot columns keyed by game_id, ready to line up with the game store
+    columns = {"game_id": [], "woba": [], "plate_appearances": [], "fip": [], "era": [], "innings": []}
+    with stage("rolling stats") as record:
+        for snapshot in iter_snapshots(path, start_season, end_season):
+            for name, values in columns.items():
+                values.append(getattr(snapshot, name))
+        record.items += len(columns["game_id"])
+    return {name: np.array(values) for name, values in columns.items()}
+
+
+def rolling_feature_matrix(table: Dict[str, np.ndarray], game_ids: np.ndarray) -> np.ndarray:
+    # Batter wOBA then starter FIP for each game in game_ids, in the player ID matrix's slot order
+    order = np.argsort(table["game_id"])
+    rows = order[np.minimum(np.searchsorted(table["game_id"], game_ids, sorter=order), len(order)-1)]
+    if not np.array_equal(table["game_id"][rows], game_ids):
+        raise KeyError("Some games have no rolling stats snapshot")
+    return np.concatenate([table["woba"][rows], table["fip"][rows]], axis=1)
+
+
+if __name__ == "__main__":
+    from acquire_data import RETRO_EVENTS_DIR
+    start_season, end_season = (int(arg) for arg in sys.argv[1:3]) if len(sys.argv) > 2 else (2003, 2023)
+    np.savez(ROLLING_STATS_PATH, **rolling_table(RETRO_EVENTS_DIR, start_season, end_season))
@@ -0,0 +1,100 @@
+from __future__ import annotations
+from typing import List, TYPE_CHECKING
+from instrumentation import stage
+import datetime
+import hashlib
+import os
+import time
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+STAT_CACHE_DIR = ".\\stats"  # One .npz of columns per (endpoint, season, stat columns, qual)
+CURRENT_SEASON_MAX_AGE = 12*60*60  # Seconds before an in-progress season is fetched again
+SEASON_END_DATE = (11, 1)  # (month, day) after which a season's stats are final
+OFFLINE = False  # Never touch the network, a missing season raises StatCacheMiss instead
+
+
+class StatCacheMiss(LookupError):
+    pass
+
+
+def cache_path(endpoint: str, season: int, stat_columns: List[str], qual: int) -> str:
+    # Column order doesn't change what FanGraphs returns, so it doesn't change the key either
+    columns_hash = hashlib.sha1(",".join(sorted(stat_columns)).encode()).hexdigest()[:12]
+    return os.path.join(STAT_CACHE_DIR, f"{endpoint}_{season}_q{qual}_{columns_hash}.npz")
+
+
+def is_fresh(path: str, season: int) -> bool:
+    # A copy written after the season ended never changes, anything earlier is refetched once it's old enough
+    if not os.path.exists(path):
+        return False
+    mtime = os.path.getmtime(path)
+    season_end = datetime.datetime(season, *SEASON_END_DATE).timestamp()
+    if mtime >= season_end:
+        return True
+    return time.time() - mtime < CURRENT_SEASON_MAX_AGE
+
+
+def save_season(path: str, data: pd.DataFrame):
+    # Text columns are stored as fixed-width unicode so the file loads without pickle
+    columns = {}
+    for name in data.columns:
+        values = data[name].to_numpy()
+        columns[str(name)] = values.astype(str) if values.dtype == object else values
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file:
+        np.savez(file, **columns)
+    os.replace(temp_path, path)  # An interrupted write never leaves a half written season behind
+
+
+def load_season(path: str) -> pd.DataFrame:
+    import pandas as pd
+    with np.load(path) as data:
+        return pd.DataFrame({name: data[name] for name in data.files})
+
+
+def fetch_seasons(endpoint: str, start_season: int, end_season: int, stat_columns: List[str], qual: int) -> pd.DataFrame:
+    import pybaseball
+    fetch = getattr(pybaseball, endpoint)
+    return fetch(start_season=start_season, end_season=end_season, stat_columns=stat_columns,
+                 split_seasons=True, qual=qual)
+
+
+def season_runs(seasons: List[int]) -> List[List[int]]:
+    # e.g. [2000, 2001, 2002, 2005] -> [[2000, 2001, 2002], [2005]]
+    runs = []
+    for season in sorted(seasons):
+        if len(runs) > 0 and runs[-1][-1] == season - 1:
+            runs[-1].append(season)
+        else:
+            runs.append([season])
+    return runs
+
+
+def cached_stats(endpoint: str, start_season: int, end_season: int, stat_columns: List[str],
+                 qual: int) -> pd.DataFrame:
+    # Same table as pybaseball.<endpoint>(..., split_seasons=True), only fetching the seasons that aren't cached
+    import pandas as pd
+    seasons = list(range(start_season, end_season+1))
+    paths = {season: cache_path(endpoint, season, stat_columns, qual) for season in seasons}
+    with stage("stat cache") as record:
+        stale = [season for season in seasons if not is_fresh(paths[season], season)]
+        if OFFLINE:
+            missing = [season for season in stale if not os.path.exists(paths[season])]
+            if len(missing) > 0:
+                raise StatCacheMiss(f"{endpoint} has no cached data for {missing} and offline mode is on")
+            stale = []  # An out of date copy of the current season is better than nothing offline
+        for run in season_runs(stale):
+            # One request per run of consecutive stale seasons, so fresh seasons in between are never refetched
+            data = fetch_seasons(endpoint, run[0], run[-1], stat_columns, qual)
+            for season in run:
+                save_season(paths[season], data[data["Season"] == season].reset_index(drop=True))
+        record.items += len(seasons)
+        record.cache_hits += len(seasons) - len(stale)
+        record.cache_misses += len(stale)
+        return pd.concat([load_season(paths[season]) for season in seasons], ignore_index=True)
@@ -0,0 +1,196 @@
+from __future__ import annotations
+from typing import Dict, List, Tuple, TYPE_CHECKING
+from odds_scraping import ODDS_BOX_CLASS
+import datetime
+import csv
+import os
+import random
+
+import numpy as np
+
+# Realistic-looking Retrosheet files, FanGraphs tables and odds pages for running the pipeline offline
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+TEAMS = ["ANA", "ARI", "ATL", "BAL", "BOS", "CHA", "CHN", "CIN", "CLE", "COL", "DET", "HOU", "KCA", "LAN", "MIA",
+         "MIL", "MIN", "NYA", "NYN", "OAK", "PHI", "PIT", "SDN", "SEA", "SFN", "SLN", "TBA", "TEX", "TOR", "WAS"]
+N_HITTERS = 13  # Per team roster
+N_PITCHERS = 13
+SEASON_DAYS = 162
+PLATE_APPEARANCES = 38  # Per team per game
+# Mix of plate appearance outcomes, roughly in MLB proportions
+EVENTS = [("K", 22), ("63/G", 10), ("8/F", 9), ("43/G", 8), ("S8/G", 10), ("S7/L.1-3", 5), ("W", 8), ("D7/L", 4),
+          ("HR/F78", 3), ("T9/F", 1), ("HP", 1), ("IW", 1), ("64(1)3/GDP", 2), ("E6/G", 1), ("FC5/G.3X3(52)", 1),
+          ("9/SF.3-H", 1), ("K+SB2", 1), ("NP", 2)]
+
+
+def team_roster(team: str) -> Tuple[List[str], List[str]]:
+    # Retrosheet style 8 character IDs, the same players every season
+    hitters = [f"{team.lower()}h{i:03}1" for i in range(N_HITTERS)]
+    pitchers = [f"{team.lower()}p{i:03}1" for i in range(N_PITCHERS)]
+    return hitters, pitchers
+
+
+def all_retro_ids(n_teams: int = len(TEAMS)) -> List[str]:
+    ids = []
+    for team in TEAMS[:n_teams]:
+        hitters, pitchers = team_roster(team)
+        ids.extend(hitters + pitchers)
+    return ids
+
+
+def fangraphs_ids(n_teams: int = len(TEAMS)) -> Dict[str, int]:
+    return {retro_id: 1000 + idx for idx, retro_id in enumerate(all_retro_ids(n_teams))}
+
+
+def game_lines(rng: random.Random, home: str, away: str, date: datetime.date, number: int) -> List[str]:
+    home_hitters, home_pitchers = team_roster(home)
+    away_hitters, away_pitchers = team_roster(away)
+    lineups, starters = {}, {}
+    lines = []
+    for side, hitters, pitchers in [(0, away_hitters, away_pitchers), (1, home_hitters, home_pitchers)]:
+        lineups[side] = rng.sample(hitters, 9)
+        starters[side] = pitchers[rng.randrange(5)]  # Five man rotation
+    home_won = rng.random() < 0.54
+    relief = {side: rng.choice(pitchers[5:]) for side, pitchers in [(0, away_pitchers), (1, home_pitchers)]}
+    winner = 1 if home_won else 0
+    winning_pitcher = starters[winner] if rng.random() < 0.6 else relief[winner]
+
+    lines.append(f"id,{home}{date:%Y%m%d}{number}")
+    lines.append("version,2")
+    lines.append(f"info,visteam,{away}")
+    lines.append(f"info,hometeam,{home}")
+    lines.append(f"info,site,{home}01")
+    lines.append(f"info,date,{date:%Y/%m/%d}")
+    lines.append(f"info,number,{number}")
+    lines.append(f"info,wp,{winning_pitcher}")
+    lines.append(f"info,lp,{starters[1-winner]}")
+    for side in [0, 1]:
+        for spot, player in enumerate(lineups[side]):
+            # Positions 2-9 then the DH
+            lines.append(f'start,{player},"Player {player}",{side},{spot+1},{spot+2}')
+        lines.append(f'start,{starters[side]},"Player {starters[side]}",{side},0,1')
+
+    events, weights = zip(*EVENTS)
+    batter_idx = {0: 0, 1: 0}
+    pitcher = dict(starters)
+    for pa in range(2*PLATE_APPEARANCES):
+        side = pa % 2
+        inning = pa // 8 + 1
+        if pa == PLATE_APPEARANCES:
+            for relief_side in [0, 1]:
+                pitcher[relief_side] = relief[relief_side]
+                lines.append(f'sub,{relief[relief_side]},"Player {relief[relief_side]}",{relief_side},0,1')
+        batter = lineups[side][batter_idx[side] % 9]
+        batter_idx[side] += 1
+        lines.append(f"play,{inning},{side},{batter},22,CBFX,{rng.choices(events, weights)[0]}")
+        if rng.random() < 0.01:
+            lines.append('com,"Synthetic comment"')
+    for side in [0, 1]:
+        lines.append(f"data,er,{starters[side]},{rng.randint(0, 6)}")
+        lines.append(f"data,er,{relief[side]},{rng.randint(0, 2)}")
+    return lines
+
+
+def write_event_files(path: str, start_season: int, n_seasons: int, n_teams: int = len(TEAMS),
+                      seed: int = 0) -> List[str]:
+    # One file of home games per team-season, named like Retrosheet's (e.g. 2003NYA.EVA)
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    teams = TEAMS[:n_teams]
+    written = []
+    for season in range(start_season, start_season+n_seasons):
+        home_games = {team: [] for team in teams}
+        for day in range(SEASON_DAYS):
+            date = datetime.date(season, 4, 1) + datetime.timedelta(days=day)
+            order = rng.sample(teams, len(teams))
+            for home, away in zip(order[::2], order[1::2]):
+                # Occasional doubleheaders exercise game_number
+                numbers = [1, 2] if rng.random() < 0.02 else [0]
+                for number in numbers:
+                    home_games[home].extend(game_lines(rng, home, away, date, number))
+        for team, lines in home_games.items():
+            file_path = os.path.join(path, f"{season}{team}.EVA")
+            with open(file_path, "w") as file:
+                file.write("\n".join(lines) + "\n")
+            written.append(file_path)
+    return written
+
+
+def write_register(path: str, n_teams: int = len(TEAMS)):
+    # Minimal stand-in for the Chadwick register's people.csv
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["key_retro", "key_fangraphs"])
+        for retro_id, fgid in fangraphs_ids(n_teams).items():
+            writer.writerow([retro_id, fgid])
+
+
+def stat_tables(start_season: int, n_seasons: int, n_teams: int = len(TEAMS), seed: int = 0,
+                missing: float = 0.1) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    # FanGraphs-like batting and pitching tables, with some players missing to exercise the defaults
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    ids = fangraphs_ids(n_teams)
+    hitters = [fgid for retro_id, fgid in ids.items() if retro_id[3] == "h"]
+    pitchers = [fgid for retro_id, fgid in ids.items() if retro_id[3] == "p"]
+
+    def table(players: List[int]) -> Dict[str, np.ndarray]:
+        seasons = np.repeat(np.arange(start_season, start_season+n_seasons), len(players))
+        idfg = np.tile(players, n_seasons)
+        keep = rng.random(len(idfg)) >= missing
+        return {"IDfg": idfg[keep], "Season": seasons[keep]}
+
+    batting = table(hitters)
+    batting["BsR"] = rng.normal(0, 3, len(batting["IDfg"]))
+    batting["wRC+"] = rng.normal(100, 25, len(batting["IDfg"]))
+    batting["Def"] = rng.normal(0, 6, len(batting["IDfg"]))
+    pitching = table(pitchers)
+    pitching["FIP"] = rng.normal(4.2, 0.7, len(pitching["IDfg"]))
+    pitching["BABIP"] = rng.normal(0.295, 0.02, len(pitching["IDfg"]))
+    return pd.DataFrame(batting), pd.DataFrame(pitching)
+
+
+def american_line(prob: float) -> int:
+    return int(round(-100*prob/(1-prob))) if prob >= 0.5 else int(round(100*(1-prob)/prob))
+
+
+def odds_page(rng: random.Random, n_games: int) -> str:
+    boxes = []
+    for _ in range(n_games):
+        home_prob = rng.uniform(0.3, 0.7)
+        home_won = rng.random() < home_prob
+        # Bookmakers shade both sides, which is the vig
+        home_line = american_line(min(home_prob + 0.02, 0.95))
+        away_line = american_line(min(1 - home_prob + 0.02, 0.95))
+        for line, won in [(home_line, home_won), (away_line, not home_won)]:
+            green = " gradient-green" if won else ""
+            boxes.append(f'<div class="{ODDS_BOX_CLASS}"><p class="height-content{green}">'
+                         f'{"+" if line > 0 else ""}{line}</p></div>')
+    rows = "\n".join(f'<div class="eventRow">{box}</div>' for box in boxes)
+    return f"<html><head><title>Results</title></head><body><div class='results'>\n{rows}\n</div></body></html>"
+
+
+def write_odds_pages(path: str, start_season: int, n_seasons: int, pages_per_season: int = 50,
+                     games_per_page: int = 50, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    written = []
+    for season in range(start_season, start_season+n_seasons):
+        for page in range(1, pages_per_season+1):
+            file_path = os.path.join(path, f"odds_{season}_{page:02}.html")
+            with open(file_path, "w", encoding="utf-16") as file:
+                file.write(odds_page(rng, games_per_page))
+            written.append(file_path)
+    return written
+
+
+def write_dataset(path: str, n_games: int, n_features: int = 56, seed: int = 0):
+    # A dataset.npz with the same arrays generate_numpy_dataset writes
+    rng = np.random.default_rng(seed)
+    features = rng.normal(size=(n_games, n_features))
+    results = (rng.random((n_games, 1)) < 0.54).astype(int)
+    feature_names = np.array([f"feature_{i}" for i in range(n_features)], dtype=np.str_)
+    game_ids = np.array([f"SYN{i:09}" for i in range(n_games)], dtype=np.str_)
+    np.savez(path, feature_names=feature_names, features=features, results=results, game_ids=game_ids)
@@ -0,0 +1,118 @@
+from typing import Tuple
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import acquire_data
+import synthetic_data
+from acquire_data import (FeatureStore, StatIndex, build_feature_matrix, game_to_features, games_to_id_matrix,
+                          update_season, BATTER_STATS, FIELDER_STATS, N_BATTERS, pitcher_stats)
+from baseball_types import GameTable
+from event_log_parser import PlayerIdResolver, find_win_loss, parse_event_files
+from instrumentation import REPORT
+
+
+N_TEAMS = 6
+
+
+def test_stat_index_empty_table():
+    # FanGraphs returns nothing for the first weeks of a season with a qual filter, every lookup uses the defaults
+    batting = pd.DataFrame({"IDfg": np.array([], dtype=np.int64), "Season": np.array([], dtype=np.int64),
+                            "BsR": np.array([]), "wRC+": np.array([]), "Def": np.array([])})
+    pitching = pd.DataFrame({"IDfg": np.array([], dtype=np.int64), "Season": np.array([], dtype=np.int64),
+                             "FIP": np.array([]), "BABIP": np.array([])})
+    batting_index = StatIndex(batting, ["BsR", "wRC+", "Def"])
+    pitching_index = StatIndex(pitching, ["FIP", "BABIP"])
+
+    values = batting_index.lookup(np.array([[1001, 1002], [-1, 5]]), 2024, BATTER_STATS)
+    assert values.shape == (2, 2, len(BATTER_STATS))
+    assert np.all(values == np.array([default for _, default in BATTER_STATS]))
+
+    # What Predictor.features does for an early season slate
+    player_ids = np.arange(2*36).reshape(2, 36)
+    features = build_feature_matrix(player_ids, np.array([2024, 2024]), batting_index, pitching_index,
+                                    BATTER_STATS, FIELDER_STATS, pitcher_stats)
+    expected = ([default for _, default in BATTER_STATS]*18 + [default for _, default in FIELDER_STATS]*16
+                + [default for _, default in pitcher_stats(2024)]*2)
+    assert np.array_equal(features, np.array([expected, expected]))
+
+
+@pytest.fixture(scope="module")
+def season_data(tmp_path_factory) -> Tuple[GameTable, StatIndex, StatIndex]:
+    # Two resolved synthetic seasons, small enough to build every way in a second
+    path = tmp_path_factory.mktemp("season_data")
+    files = synthetic_data.write_event_files(str(path / "events"), 2003, 2, N_TEAMS)
+    synthetic_data.write_register(str(path / "people.csv"), N_TEAMS)
+    resolver = PlayerIdResolver(cache_path=str(path / "ids.csv"), register_path=str(path / "people.csv"))
+    games = parse_event_files(files, resolver)
+    find_win_loss(games)
+    batting, pitching = synthetic_data.stat_tables(2003, 2, N_TEAMS)
+    return GameTable.from_games(games), StatIndex(batting, ["BsR", "wRC+", "Def"]), StatIndex(pitching, ["FIP", "BABIP"])
+
+
+def feature_store_counts() -> Tuple[int, int]:
+    record = REPORT.stages.pop("feature store")
+    return record.cache_hits, record.cache_misses
+
+
+def test_feature_store_matches_per_game_features(season_data, tmp_path):
+    games, batting_index, pitching_index = season_data
+    store = FeatureStore(str(tmp_path))
+    features = store.build(games, batting_index, pitching_index, BATTER_STATS, FIELDER_STATS, pitcher_stats)
+    player_ids, seasons, _ = games_to_id_matrix(games)
+    batch = build_feature_matrix(player_ids, seasons, batting_index, pitching_index,
+                                 BATTER_STATS, FIELDER_STATS, pitcher_stats)
+    per_game = np.stack([game_to_features(game, batting_index, pitching_index, BATTER_STATS, FIELDER_STATS,
+                                          pitcher_stats(game.year)) for game in games])
+    assert np.array_equal(features, batch)
+    assert np.array_equal(features, per_game)
+
+
+def test_feature_store_reuses_columns(season_data, tmp_path):
+    games, batting_index, pitching_index = season_data
+    store = FeatureStore(str(tmp_path))
+    REPORT.stages.pop("feature store", None)
+    first = store.build(games, batting_index, pitching_index, BATTER_STATS, FIELDER_STATS, pitcher_stats)
+    n_columns = first.shape[1]
+    assert feature_store_counts() == (0, 2*n_columns)
+
+    second = store.build(games, batting_index, pitching_index, BATTER_STATS, FIELDER_STATS, pitcher_stats)
+    assert feature_store_counts() == (2*n_columns, 0)
+    assert np.array_equal(first, second)
+
+    # A new batter stat is one column per lineup spot and season, everything else is read back
+    batter_stats = BATTER_STATS + [("Def", -4.0)]
+    grown = store.build(games, batting_index, pitching_index, batter_stats, FIELDER_STATS, pitcher_stats)
+    assert feature_store_counts() == (2*n_columns, 2*N_BATTERS)
+    player_ids, seasons, _ = games_to_id_matrix(games)
+    assert np.array_equal(grown, build_feature_matrix(player_ids, seasons, batting_index, pitching_index,
+                                                      batter_stats, FIELDER_STATS, pitcher_stats))
+
+
+def test_update_season_records_match_full_parse(tmp_path, monkeypatch):
+    files = synthetic_data.write_event_files(str(tmp_path / "all_events"), 2003, 1, N_TEAMS)
+    synthetic_data.write_register(str(tmp_path / "people.csv"), N_TEAMS)
+    resolver = PlayerIdResolver(cache_path=str(tmp_path / "ids.csv"), register_path=str(tmp_path / "people.csv"))
+    events_dir = tmp_path / "events"
+    events_dir.mkdir()
+    monkeypatch.setattr(acquire_data, "RETRO_EVENTS_DIR", str(events_dir))
+    monkeypatch.setattr(acquire_data, "GAMES_DIR", str(tmp_path / "games"))
+
+    # One team's home games show up after the rest of the season is already stored
+    for file in files[:-1]:
+        shutil.copy(file, events_dir)
+    assert update_season(2003, resolver, None)
+    shutil.copy(files[-1], events_dir)
+    assert update_season(2003, resolver, None)
+    assert not update_season(2003, resolver, None)
+
+    games = parse_event_files(files, resolver)
+    find_win_loss(games)
+    expected = GameTable.from_games(games).columns
+    stored = GameTable.load(acquire_data.season_dir(2003)).columns
+    expected_order = np.argsort(expected["game_id"])
+    stored_order = np.argsort(stored["game_id"])
+    for name in GameTable.COLUMNS:
+        assert np.array_equal(stored[name][stored_order], expected[name][expected_order]), name
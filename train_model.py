@@ -1,49 +1,110 @@
+from __future__ import annotations
 import os
-os.add_dll_directory(r"C:\Program Files\NVIDIA GPU Computing Toolkit\CUDA\v11.7\bin")
-import tensorflow as tf
-import keras_tuner as kt
 import numpy as np
-from sklearn.model_selection import train_test_split
 from datetime import datetime
+from pathlib import Path
+import argparse
+import csv
+import functools
+import multiprocessing
+import time
+from typing import TYPE_CHECKING
 
-from acquire_data import DATASET_PATH, generate_numpy_dataset
+from acquire_data import DATASET_PATH, SHARD_DIR, generate_numpy_dataset, export_shards
+from instrumentation import stage
 
 
 BATCH_SIZE = 64
 SHUFFLE_BUFFER = 150
-N_FEATURES = 56
-
-def prep_dataset(normalizer: tf.keras.layers.Normalization=None):
-    if not os.path.exists(DATASET_PATH):
-        generate_numpy_dataset(2003, 2023)
-
-    with np.load(DATASET_PATH) as data:
-        features = data["features"]
-        results = data["results"]
-
-    X_train, X_test, y_train, y_test = train_test_split(features, results, train_size=0.8, shuffle=True)
-    X_train, X_valid, y_train, y_valid = train_test_split(X_train, y_train, train_size=0.8, shuffle=True)
+TUNER_DIR = "models/tuner"
+PROJECT_NAME = "baseball_ml"
+MAX_TRIALS = 20
+TRIAL_REPORT_PATH = os.path.join(TUNER_DIR, "trial_times.csv")
+NORMALIZATION_PATH = os.path.join(TUNER_DIR, "normalization.npz")
+ORACLE_PORT = "8000"
+CUDA_BIN = r"C:\Program Files\NVIDIA GPU Computing Toolkit\CUDA\v11.7\bin"
+
+# --cpu mode is supported with keras-tuner 1.3.x and 1.4.x, the distributed oracle API changes between releases
+# TensorFlow and keras_tuner take seconds to import, so they're only loaded by the functions that use them
+if TYPE_CHECKING:
+    import tensorflow as tf
+    import keras_tuner as kt
+
+@functools.lru_cache(maxsize=None)
+def import_tensorflow():
+    if os.path.isdir(CUDA_BIN):
+        os.add_dll_directory(CUDA_BIN)
+    import tensorflow as tf
+    return tf
+
+def feature_count(shard_dir: str = SHARD_DIR) -> int:
+    # Read from the shards, so the model always matches whatever feature spec built the dataset
+    path = next(Path(shard_dir).glob("*_features.npy"))
+    return np.load(path, mmap_mode="r").shape[1]
+
+def shard_dataset(split: str, shard_dir: str = SHARD_DIR) -> tf.data.Dataset:
+    # Streams memory-mapped shards in chunks so the full dataset never has to be in memory
+    tf = import_tensorflow()
+    paths = sorted(str(path) for path in Path(shard_dir).glob(f"{split}_*_features.npy"))
+    n_features = feature_count(shard_dir)
+
+    def read_shard(path):
+        path = path.decode()
+        features = np.load(path, mmap_mode="r")
+        results = np.load(path.replace("_features.npy", "_results.npy"), mmap_mode="r")
+        for start in range(0, len(features), BATCH_SIZE):
+            yield features[start:start+BATCH_SIZE], results[start:start+BATCH_SIZE]
+
+    signature = (tf.TensorSpec(shape=(None, n_features), dtype=tf.float32),
+                 tf.TensorSpec(shape=(None, 1), dtype=tf.float32))
+    dataset = tf.data.Dataset.from_tensor_slices(paths).interleave(
+        lambda path: tf.data.Dataset.from_generator(read_shard, args=(path,), output_signature=signature),
+        cycle_length=len(paths), num_parallel_calls=tf.data.AUTOTUNE
+    )
+    return dataset.unbatch()
+
+def prep_dataset(normalizer: tf.keras.layers.Normalization=None, shard_dir: str = SHARD_DIR,
+                 adapt: bool = True, cache: bool = False):
+    tf = import_tensorflow()
+    if not any(Path(shard_dir).glob("*.npy")):
+        if not os.path.exists(DATASET_PATH):
+            generate_numpy_dataset(2003, 2023)
+        if not any(Path(shard_dir).glob("*.npy")):
+            export_shards(shard_dir=shard_dir)
+
+    training_dataset = shard_dataset("train", shard_dir)  # For training the model
+    validation_dataset = shard_dataset("valid", shard_dir)  # For stopping our model overfitting
+    testing_dataset = shard_dataset("test", shard_dir)  # To evaluate at the very end
+
+    if cache:
+        # Keeps the decoded rows in memory so repeated fits (e.g. tuner trials) skip the shard reads
+        training_dataset = training_dataset.cache()
+        validation_dataset = validation_dataset.cache()
+
+    training_dataset = training_dataset.shuffle(SHUFFLE_BUFFER).batch(BATCH_SIZE)
+    validation_dataset = validation_dataset.batch(BATCH_SIZE)
+    testing_dataset = testing_dataset.batch(BATCH_SIZE)
 
     if normalizer is not None:
-        normalizer.adapt(X_train)
-        X_train = normalizer(X_train)
-        X_valid = normalizer(X_valid)
-
-    training_dataset = tf.data.Dataset.from_tensor_slices((X_train, y_train))  # For training the model
-    validation_dataset = tf.data.Dataset.from_tensor_slices((X_valid, y_valid))  # For stopping our model overfitting
-    testing_dataset = tf.data.Dataset.from_tensor_slices((X_test, y_test))  # To evaluate at the very end
+        # adapt streams over the training data, then normalization runs inside the pipeline
+        if adapt:
+            normalizer.adapt(training_dataset.map(lambda x, _: x))
+        training_dataset = training_dataset.map(lambda x, y: (normalizer(x), y), num_parallel_calls=tf.data.AUTOTUNE)
+        validation_dataset = validation_dataset.map(lambda x, y: (normalizer(x), y))
 
-    training_dataset = training_dataset.shuffle(SHUFFLE_BUFFER).batch(BATCH_SIZE).prefetch(tf.data.AUTOTUNE)
-    validation_dataset = validation_dataset.batch(BATCH_SIZE)
-    testing_dataset = testing_dataset.batch(BATCH_SIZE)
+    training_dataset = training_dataset.prefetch(tf.data.AUTOTUNE)
+    validation_dataset = validation_dataset.prefetch(tf.data.AUTOTUNE)
+    testing_dataset = testing_dataset.prefetch(tf.data.AUTOTUNE)
 
     return training_dataset, validation_dataset, testing_dataset
 
-def generate_model(hp: kt.HyperParameters):
+def generate_model(hp: kt.HyperParameters, n_features: int = None):
+    tf = import_tensorflow()
+    n_features = feature_count() if n_features is None else n_features
     n_neurons = hp.Int("n_neurons", min_value=16, max_value=128, step=16)
     n_layers = hp.Int("n_layers", min_value=1, max_value=10)
     model = tf.keras.Sequential([
-        tf.keras.layers.InputLayer(input_shape=(N_FEATURES,))
+        tf.keras.layers.InputLayer(input_shape=(n_features,))
     ]+[
         tf.keras.layers.Dense(n_neurons, activation="selu", kernel_initializer="lecun_normal") for _ in range(n_layers)
     ]+[
@@ -54,6 +115,7 @@ def generate_model(hp: kt.HyperParameters):
     return model
 
 def baseline_mse(dataset: tf.data.Dataset) -> float:
+    tf = import_tensorflow()
     count = 0
     sum = 0
     for _, res in dataset:
@@ -62,31 +124,113 @@ def baseline_mse(dataset: tf.data.Dataset) -> float:
         sum += tf.reduce_sum(sqdiff).numpy()
     return sum/count
 
-if __name__ == "__main__":
-    using_gpu = len(tf.config.list_physical_devices('GPU')) > 0
-    assert(using_gpu)
-
-    norm_layer = tf.keras.layers.Normalization(input_shape=(N_FEATURES,))
+def make_tuner(overwrite: bool) -> kt.Tuner:
+    import keras_tuner as kt
+
+    class TimedBayesianOptimization(kt.BayesianOptimization):
+        # Appends how long each trial took to TRIAL_REPORT_PATH
+        def run_trial(self, trial, *args, **kwargs):
+            start = time.perf_counter()
+            histories = super().run_trial(trial, *args, **kwargs)
+            elapsed = time.perf_counter() - start
+
+            # Workers share the file, each row goes out as a single append so rows never interleave
+            with open(TRIAL_REPORT_PATH, "a", newline="") as file:
+                writer = csv.writer(file)
+                writer.writerow([os.environ.get("KERASTUNER_TUNER_ID", "main"), trial.trial_id, f"{elapsed:.2f}",
+                                 trial.hyperparameters.get("n_neurons"), trial.hyperparameters.get("n_layers")])
+            return histories
+
+    if overwrite:
+        # Only the main process starts a search (parallel_search does it before spawning workers), so the header is
+        # written exactly once
+        os.makedirs(TUNER_DIR, exist_ok=True)
+        with open(TRIAL_REPORT_PATH, "w", newline="") as file:
+            csv.writer(file).writerow(["tuner_id", "trial_id", "seconds", "n_neurons", "n_layers"])
+    return TimedBayesianOptimization(generate_model, objective="val_loss", max_trials=MAX_TRIALS,
+                                     overwrite=overwrite, directory=TUNER_DIR, project_name=PROJECT_NAME)
+
+def tuner_process(tuner_id: str, threads: int):
+    # Runs in its own process, keras_tuner's chief/worker roles are picked from these environment variables
+    os.environ["KERASTUNER_TUNER_ID"] = tuner_id
+    os.environ["KERASTUNER_ORACLE_IP"] = "127.0.0.1"
+    os.environ["KERASTUNER_ORACLE_PORT"] = ORACLE_PORT
+    tf = import_tensorflow()
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    if tuner_id == "chief":
+        # keras-tuner 1.4 starts the oracle server inside search(), 1.3 already blocks serving it in the constructor
+        make_tuner(overwrite=False).search()
+        return
+
+    with np.load(NORMALIZATION_PATH) as stats:
+        normalizer = tf.keras.layers.Normalization(mean=stats["mean"], variance=stats["variance"])
+    training_dataset, validation_dataset, _ = prep_dataset(normalizer=normalizer, adapt=False, cache=True)
+    tuner = make_tuner(overwrite=False)
+    tuner.search(training_dataset, epochs=10, validation_data=validation_dataset, verbose=0)
+
+def parallel_search(norm_layer: tf.keras.layers.Normalization, workers: int) -> kt.HyperParameters:
+    # One chief holds the Bayesian oracle, each worker runs trials with an equal share of the cores
+    os.makedirs(TUNER_DIR, exist_ok=True)
+    mean, variance = norm_layer.get_weights()[:2]
+    np.savez(NORMALIZATION_PATH, mean=mean, variance=variance)
+    make_tuner(overwrite=True)  # Clears out any previous search before the chief reloads the project
+
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    context = multiprocessing.get_context("spawn")
+    chief = context.Process(target=tuner_process, args=("chief", 1))
+    chief.start()
+    time.sleep(5)  # Give the oracle server a head start before the workers connect
+    processes = [context.Process(target=tuner_process, args=(f"tuner{i}", threads)) for i in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    chief.join(timeout=60)
+    if chief.is_alive():
+        chief.terminate()
+
+    return make_tuner(overwrite=False).get_best_hyperparameters()[0]
+
+def train(cpu: bool = False, workers: int = 4):
+    tf = import_tensorflow()
+    if not cpu:
+        using_gpu = len(tf.config.list_physical_devices('GPU')) > 0
+        assert(using_gpu)
+
+    norm_layer = tf.keras.layers.Normalization()
     training_dataset, validation_dataset, testing_dataset = prep_dataset(normalizer=norm_layer)
 
-    tuner = kt.BayesianOptimization(generate_model, objective="val_loss", max_trials=20,
-                                    overwrite=True, directory="models/tuner", project_name="baseball_ml")
-    tuner.search(training_dataset, epochs=10, validation_data=validation_dataset)
-    
-    best_params = tuner.get_best_hyperparameters()[0]
+    with stage("tuner search") as record:
+        if cpu:
+            best_params = parallel_search(norm_layer, workers)
+        else:
+            tuner = make_tuner(overwrite=True)
+            tuner.search(training_dataset, epochs=10, validation_data=validation_dataset)
+            best_params = tuner.get_best_hyperparameters()[0]
+        record.items += MAX_TRIALS
     model = generate_model(best_params)
 
     lr_scheduler = tf.keras.callbacks.ReduceLROnPlateau(factor=0.5, patience=5)
     early_stopping = tf.keras.callbacks.EarlyStopping(patience=10, restore_best_weights=True)
 
-    history = model.fit(training_dataset, epochs=200, validation_data=validation_dataset,
-                        callbacks=[lr_scheduler, early_stopping])
+    with stage("training") as record:
+        history = model.fit(training_dataset, epochs=200, validation_data=validation_dataset,
+                            callbacks=[lr_scheduler, early_stopping])
+        record.items += len(history.epoch)
 
-    final_model = tf.keras.Sequential([norm_layer, model])
+    final_model = tf.keras.Sequential([tf.keras.layers.InputLayer(input_shape=(feature_count(),)), norm_layer, model])
     final_model.compile(loss=tf.keras.losses.binary_crossentropy, optimizer="sgd", metrics=["mean_squared_error"])
     bce_test, mse_test = final_model.evaluate(testing_dataset)
     mse_baseline = baseline_mse(testing_dataset)
     print(f"cross-entropy: {bce_test}, mse: {mse_test}, skill: {1-mse_test/mse_baseline}")
     datestring = datetime.now()
     model_path = datestring.strftime(".\\models\\%Y-%m-%d_%H-%M-%S.keras")
-    final_model.save(model_path)
\ No newline at end of file
+    final_model.save(model_path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cpu", action="store_true", help="run tuner trials in parallel CPU worker processes")
+    parser.add_argument("--workers", type=int, default=4, help="number of trial workers in --cpu mode")
+    args = parser.parse_args()
+    train(cpu=args.cpu, workers=args.workers)